@@ -0,0 +1,166 @@
+import os
+import sys
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from PIL import Image
+import tracing
+
+# ======================== 配置部分 ========================
+# 批处理内存预算（MB），0 表示自动：启动时可用内存的一半
+MEMORY_BUDGET_MB = int(os.environ.get("REPICBG_MEMORY_BUDGET_MB", "0"))
+# 处理一个像素的峰值内存估计：解码RGB、共享内存副本、蒙版、精修/合成的临时数组等
+BYTES_PER_PIXEL = 40
+# 每张图片的固定开销（编码缓冲区、模型输入张量等）
+BASE_COST = 32 * 1024 * 1024
+
+
+def probe_size(path):
+    """只读取文件头获取图片尺寸，不解码像素"""
+    with Image.open(path) as img:
+        return img.size
+
+
+def estimate_cost(width, height):
+    """估算处理一张图片的峰值内存（字节）"""
+    return BASE_COST + width * height * BYTES_PER_PIXEL
+
+
+def current_rss():
+    """当前进程常驻内存（字节），无法获取时返回 None"""
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+def available_memory():
+    """系统可用内存（字节），无法获取时返回 None"""
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except Exception:
+        return None
+
+
+def default_budget():
+    """默认内存预算：配置值，或 当前占用 + 可用内存的一半"""
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB * 1024 * 1024
+    available = available_memory()
+    if available is None:
+        return 2 * 1024 * 1024 * 1024
+    return (current_rss() or 0) + available // 2
+
+
+class AdaptiveBatchRunner:
+    """
+    按内存预算自适应调整并发的批处理调度器
+
+    先读文件头估算每张图片的内存开销，按从大到小的顺序提交（大图先做，
+    尾部由小图填满，负载更均衡）。提交前检查 已占用预算 + 实测常驻内存，
+    超出预算就等待；运行中实测内存接近预算时并发上限减半，内存宽裕时逐步加一。
+    """
+
+    def __init__(self, submit, max_concurrency=4, budget=None):
+        """
+        参数:
+            submit: submit(path) -> Future
+            max_concurrency: 并发上限的最大值
+            budget: 内存预算（字节），默认见 default_budget
+        """
+        self.submit = submit
+        self.max_concurrency = max(1, max_concurrency)
+        self.budget = budget or default_budget()
+        self.limit = self.max_concurrency
+        self._stopped = False
+
+    def stop(self):
+        """不再提交新的图片（已提交的仍会完成并回调），可在 on_done 中调用"""
+        self._stopped = True
+
+    @tracing.traced("probe_sizes")
+    def plan(self, paths):
+        """估算开销并按从大到小排序，返回 [(开销, 原序号, 路径)]"""
+        items = []
+        for index, path in enumerate(paths):
+            try:
+                cost = estimate_cost(*probe_size(path))
+            except Exception:
+                # 无法读取文件头的图片交给处理流程报错
+                cost = BASE_COST
+            items.append((cost, index, path))
+        items.sort(key=lambda item: -item[0])
+        return items
+
+    def _adjust(self, rss):
+        """根据实测内存调整并发上限（乘性减、加性增）"""
+        if rss is None:
+            return
+        tracing.counter("memory", rss_mb=rss // (1024 * 1024), limit=self.limit)
+        if rss > self.budget * 0.9:
+            self.limit = max(1, self.limit // 2)
+        elif rss < self.budget * 0.6 and self.limit < self.max_concurrency:
+            self.limit += 1
+
+    def run(self, paths, on_done):
+        """
+        处理一批图片（阻塞，应在后台线程调用）
+
+        参数:
+            paths: 图片路径列表
+            on_done: on_done(index, path, future)，每张完成（或提交失败）后调用，
+                index 为原序号
+        """
+        pending = self.plan(paths)
+        # Future -> [(开销, 原序号, 路径)]；调度器对同一图片返回同一个 Future，
+        # 列表中重复出现的图片共用一个 Future，完成时逐项回调
+        in_flight = {}
+        running = 0  # 已提交的条目数
+        reserved = 0
+        baseline = current_rss() or 0
+
+        while (pending and not self._stopped) or in_flight:
+            rss = current_rss()
+            while pending and not self._stopped and running < self.limit:
+                cost = pending[0][0]
+                # 没有任务在运行时总是放行，超大图片也能单独处理
+                if in_flight:
+                    if baseline + reserved + cost > self.budget:
+                        break
+                    if rss is not None and rss + cost > self.budget:
+                        break
+                item = pending.pop(0)
+                try:
+                    future = self.submit(item[2])
+                except Exception as e:
+                    # 提交失败也通过 on_done 交给调用方处理
+                    future = Future()
+                    future.set_exception(e)
+                in_flight.setdefault(future, []).append(item)
+                running += 1
+                reserved += item[0]
+
+            if not in_flight:
+                continue
+
+            done, _ = wait(list(in_flight), timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                for cost, index, path in in_flight.pop(future):
+                    running -= 1
+                    reserved -= cost
+                    on_done(index, path, future)
+            self._adjust(current_rss())
@@ -0,0 +1,94 @@
+import io
+import os
+import numpy as np
+from PIL import Image, ImageOps
+from scheduler import ResultCache
+from tracing import traced
+
+GRADIENT_DIRECTIONS = {
+    "vertical": "上下渐变",
+    "horizontal": "左右渐变",
+    "radial": "中心渐变",
+}
+
+# 按 (背景描述, 输出尺寸) 缓存缩放/裁剪好的背景，所有线程共用
+_cache = ResultCache(256 * 1024 * 1024)
+
+
+def gradient_spec(start, end, direction="vertical"):
+    """渐变背景描述：起止颜色 (R, G, B) 与方向"""
+    return ("gradient", tuple(start[:3]), tuple(end[:3]), direction)
+
+
+def image_spec(source):
+    """
+    图片背景描述
+
+    参数:
+        source: 图片路径或图片字节；路径会附带修改时间，文件更新后缓存自动失效
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return ("image", bytes(source), None)
+    return ("image", os.path.abspath(source), os.stat(source).st_mtime_ns)
+
+
+def make_gradient(size, start, end, direction="vertical"):
+    """
+    生成渐变背景
+
+    返回可广播到 (H, W, 3) 的 uint8 数组；上下/左右渐变只保存一行/一列
+    """
+    width, height = size
+    start = np.array(start[:3], dtype=np.float32)
+    end = np.array(end[:3], dtype=np.float32)
+    if direction == "horizontal":
+        t = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    elif direction == "radial":
+        y = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
+        x = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+        t = np.minimum(np.hypot(x, y) / np.sqrt(2), 1)[..., None]
+    else:
+        t = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    return (start + (end - start) * t + 0.5).astype(np.uint8)
+
+
+def _source_image(spec):
+    """读取背景原图（解码结果缓存，多个输出尺寸共用；键含修改时间，文件更新后重新读取）"""
+    key = ("source", spec)
+    img = _cache.get(key)
+    if img is None:
+        source = spec[1]
+        img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        _cache.put(key, img)
+    return img
+
+
+@traced("backdrop")
+def backdrop_for(spec, size):
+    """
+    获取指定输出尺寸的背景数组（首次按尺寸缩放/居中裁剪，之后直接命中缓存）
+
+    参数:
+        spec: gradient_spec 或 image_spec 的返回值
+        size: 输出尺寸 (宽, 高)
+
+    返回:
+        可广播到 (H, W, 3) 的 uint8 数组
+    """
+    key = (spec, tuple(size))
+    backdrop = _cache.get(key)
+    if backdrop is not None:
+        return backdrop
+
+    kind = spec[0]
+    if kind == "gradient":
+        backdrop = make_gradient(size, spec[1], spec[2], spec[3])
+    elif kind == "image":
+        src = _source_image(spec)
+        backdrop = np.asarray(ImageOps.fit(src, tuple(size), Image.LANCZOS))
+    else:
+        raise ValueError(f"未知的背景类型: {kind}")
+
+    _cache.put(key, backdrop)
+    return backdrop
@@ -0,0 +1,118 @@
+import numpy as np
+from PIL import Image
+from tracing import traced
+
+# 标准证件照尺寸（300 dpi 下的像素）：键 -> (名称, 宽, 高)
+PHOTO_SIZES = {
+    "1inch": ("1寸 (295×413)", 295, 413),
+    "small1inch": ("小1寸 (260×378)", 260, 378),
+    "large1inch": ("大1寸 (390×567)", 390, 567),
+    "2inch": ("2寸 (413×579)", 413, 579),
+    "small2inch": ("小2寸 (413×531)", 413, 531),
+}
+PHOTO_DPI = 300
+# 头部（头顶到下巴）占照片高度的比例，以及头顶上方留白的比例
+HEAD_RATIO = 0.55
+TOP_MARGIN = 0.1
+
+
+def locate_head(mask, threshold=128):
+    """
+    根据蒙版估计人像位置
+
+    参数:
+        mask: uint8 蒙版 (H, W)
+        threshold: 视为前景的最小值
+
+    返回:
+        (头顶y, 头部中心x, 头部高度)，蒙版中没有前景时返回 None
+    """
+    # 在缩小的蒙版上统计，大图也只需处理几十万像素
+    step = max(1, max(mask.shape) // 512)
+    small = mask[::step, ::step] >= threshold
+    widths = small.sum(axis=1)
+    if widths.max() == 0:
+        return None
+
+    # 忽略零星噪点行：宽度至少为最宽处的 2%
+    rows = np.nonzero(widths >= max(1, widths.max() * 0.02))[0]
+    top, bottom = rows[0], rows[-1]
+
+    # 自头顶向下，行宽超过此前最大宽度的 1.6 倍处视为肩膀
+    head_width = 0
+    shoulder = bottom + 1
+    for y in range(top, bottom + 1):
+        if head_width and y - top > head_width * 0.5 and widths[y] > head_width * 1.6:
+            shoulder = y
+            break
+        head_width = max(head_width, widths[y])
+
+    # 头部高度约为头宽的 1.3 倍（含头发），且不超过肩膀位置
+    head_height = min(head_width * 1.3, shoulder - top)
+    head_rows = small[top:top + max(1, int(head_height * 0.8))]
+    center_x = np.nonzero(head_rows)[1].mean()
+
+    return top * step, (center_x + 0.5) * step, max(1.0, head_height * step)
+
+
+def crop_box(mask, size, head_ratio=HEAD_RATIO, top_margin=TOP_MARGIN):
+    """
+    计算证件照裁剪框
+
+    参数:
+        mask: uint8 蒙版 (H, W)
+        size: 输出尺寸 (宽, 高)
+
+    返回:
+        (x0, y0, x1, y1) 原图坐标，可能超出原图范围（超出部分由背景填充）；
+        蒙版中没有前景时返回 None
+    """
+    head = locate_head(mask)
+    if head is None:
+        return None
+    top, center_x, head_height = head
+    h = mask.shape[0]
+    aspect = size[0] / size[1]
+
+    crop_h = head_height / head_ratio
+    # 裁剪框底边超出原图时放大人像，避免身体下方露出背景
+    if top - top_margin * crop_h + crop_h > h:
+        crop_h = max((h - top) / (1 - top_margin), head_height / 0.75)
+    crop_w = crop_h * aspect
+
+    y0 = top - top_margin * crop_h
+    x0 = center_x - crop_w / 2
+    return (int(round(x0)), int(round(y0)), int(round(x0 + crop_w)), int(round(y0 + crop_h)))
+
+
+@traced("id_photo_crop")
+def crop_to_size(img, mask, size):
+    """
+    按人像位置裁剪并缩放到证件照尺寸
+
+    参数:
+        img: RGB PIL图像
+        mask: uint8 蒙版 (H, W)
+        size: 输出尺寸 (宽, 高)
+
+    返回:
+        (裁剪缩放后的图像, 蒙版)；找不到人像时按中心裁剪
+    """
+    box = crop_box(mask, size)
+    if box is None:
+        w, h = img.size
+        scale = min(w / size[0], h / size[1])
+        cw, ch = size[0] * scale, size[1] * scale
+        box = (int((w - cw) / 2), int((h - ch) / 2), int((w + cw) / 2), int((h + ch) / 2))
+
+    img = _resample(img, box, size)
+    matte = _resample(Image.fromarray(np.ascontiguousarray(mask), "L"), box, size)
+    return img, np.asarray(matte)
+
+
+def _resample(img, box, size):
+    """裁剪并缩放（reducing_gap 让大倍率缩小先走整数倍 reduce）"""
+    if box[0] < 0 or box[1] < 0 or box[2] > img.width or box[3] > img.height:
+        # 超出原图的部分填0，蒙版为0处合成时由背景填充
+        img, box = img.crop(box), None
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
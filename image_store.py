@@ -0,0 +1,98 @@
+import os
+from PIL import Image, ImageOps
+from matting import load_image
+from scheduler import ResultCache
+
+
+def fit_size(width, height, max_width, max_height):
+    """保持宽高比缩放到不超过画布的尺寸（不放大）"""
+    max_width, max_height = max(1, max_width), max(1, max_height)
+    if width / height > max_width / max_height:
+        new_width = min(width, max_width)
+        new_height = int(new_width * height / width)
+    else:
+        new_height = min(height, max_height)
+        new_width = int(new_height * width / height)
+    return max(1, new_width), max(1, new_height)
+
+
+class ImageStore:
+    """
+    解码图片共享缓存
+
+    以 路径+修改时间 为键缓存按EXIF方向校正后的RGB图像、逐级减半的预览金字塔
+    和画布尺寸的预览图；缩略图、预览和抠图都从这里取图，同一文件只解码一次。
+    总占用按字节数限制，超出时淘汰最久未用的条目。
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.cache = ResultCache(max_bytes)
+
+    def _key(self, path, *kind):
+        path = os.path.abspath(path)
+        return (path, os.stat(path).st_mtime_ns) + kind
+
+    def get(self, path, keep=True):
+        """
+        获取完整解码图像
+
+        参数:
+            path: 图片路径
+            keep: 是否放入缓存（批处理时传 False，避免挤掉交互所需的图像）
+        """
+        key = self._key(path, "full")
+        img = self.cache.get(key)
+        if img is None:
+            img = load_image(path)
+            if keep:
+                self.cache.put(key, img)
+        return img
+
+    def _level(self, path, level):
+        """预览金字塔第 level 层（第0层为原图，每层边长减半）"""
+        if level == 0:
+            return self.get(path)
+        key = self._key(path, "level", level)
+        img = self.cache.get(key)
+        if img is None:
+            img = self._level(path, level - 1).reduce(2)
+            self.cache.put(key, img)
+        return img
+
+    def get_preview(self, path, max_width, max_height):
+        """获取适合画布尺寸的预览图（从金字塔中最接近的一层缩放得到）"""
+        full = self.get(path)
+        size = fit_size(full.width, full.height, max_width, max_height)
+        key = self._key(path, "preview", size)
+        img = self.cache.get(key)
+        if img is not None:
+            return img
+
+        # 选取仍不小于目标尺寸的最小一层，再做一次高质量缩放
+        level = 0
+        while (full.width >> (level + 1)) >= size[0] and (full.height >> (level + 1)) >= size[1]:
+            level += 1
+        img = self._level(path, level)
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        self.cache.put(key, img)
+        return img
+
+    def get_thumbnail(self, path, size=80):
+        """获取缩略图；原图未缓存时用 draft 按比例解码，不占用完整图像的缓存"""
+        key = self._key(path, "thumbnail", size)
+        img = self.cache.get(key)
+        if img is not None:
+            return img
+
+        full = self.cache.get(self._key(path, "full"))
+        if full is not None:
+            factor = max(1, min(full.width, full.height) // (size * 2))
+            img = full.reduce(factor) if factor > 1 else full.copy()
+        else:
+            img = Image.open(path)
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((size, size))
+        self.cache.put(key, img)
+        return img
@@ -0,0 +1,298 @@
+import os
+import atexit
+import itertools
+import threading
+import multiprocessing as mp
+from collections import deque
+from multiprocessing import connection, shared_memory
+import numpy as np
+import tracing
+from tracing import traced
+
+# ======================== 配置部分 ========================
+# REPICBG_WORKERS=0 表示不启用进程池，在当前进程内推理
+INFERENCE_WORKERS = int(os.environ.get("REPICBG_WORKERS", "0"))
+# 每个推理进程使用的 ORT 线程数；进程数 x 线程数 不宜超过CPU核心数
+ORT_THREADS = int(os.environ.get("REPICBG_ORT_THREADS", "1"))
+# 写入共享内存时每次拷贝的行数，临时内存只占一个条带
+COPY_ROWS = 256
+
+
+def _copy_pixels(img, out):
+    """按行条带把图像（必要时转为RGB）拷入 out，不产生整幅图像的临时副本"""
+    if img.mode == "RGB" and img.height <= COPY_ROWS:
+        out[...] = np.asarray(img)
+        return
+    for y in range(0, img.height, COPY_ROWS):
+        band = img.crop((0, y, img.width, min(y + COPY_ROWS, img.height)))
+        if band.mode != "RGB":
+            band = band.convert("RGB")
+        out[y:y + band.height] = np.asarray(band)
+
+
+def _predict_into(session, src, dst, shape):
+    """在共享内存上直接推理，蒙版写入输出缓冲区；返回错误信息或 None"""
+    from PIL import Image
+    from matting import predict_mask
+
+    pixels = np.ndarray(shape, dtype=np.uint8, buffer=src.buf)
+    out = np.ndarray(shape[:2], dtype=np.uint8, buffer=dst.buf)
+    try:
+        out[...] = predict_mask(session, Image.fromarray(pixels, "RGB"))
+        return None
+    except Exception as e:
+        return str(e)
+    finally:
+        # 释放对共享内存的引用，之后才能 close
+        del pixels, out
+
+
+def _worker_main(model_name, ort_threads, conn):
+    """推理进程入口：常驻一个ONNX会话，循环处理主进程经管道派发的任务"""
+    # rembg 创建会话时读取 OMP_NUM_THREADS 设置 ORT 线程数
+    os.environ["OMP_NUM_THREADS"] = str(ort_threads)
+    # 子进程不自行记录和导出追踪，推理耗时随结果回报给主进程
+    tracing.disable()
+    tracing.clear()
+    from rembg import new_session
+
+    session = new_session(model_name)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        task_id, src_name, dst_name, shape = task
+        try:
+            src = shared_memory.SharedMemory(name=src_name)
+            dst = shared_memory.SharedMemory(name=dst_name)
+        except Exception as e:
+            conn.send((task_id, str(e), None))
+            continue
+
+        # 推理耗时随结果一起回报，由主进程写入它的追踪记录
+        start = tracing.now()
+        error = _predict_into(session, src, dst, shape)
+        timing = (start, tracing.now(), os.getpid(), threading.get_native_id())
+        src.close()
+        dst.close()
+        conn.send((task_id, error, timing))
+
+
+class _Worker:
+    """一个推理进程及其管道，task 为正在处理的任务ID"""
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.task = None
+        self.completed = 0
+
+
+class InferencePool:
+    """
+    多进程推理池
+
+    每个进程常驻一个预热好的ONNX会话；解码后的像素和返回的蒙版都通过
+    multiprocessing.shared_memory 传递，子进程直接在共享内存上建立
+    NumPy 视图，不对多兆字节的图像做 pickle。
+
+    每个进程一条独立管道，由监听线程逐个派发任务，因此知道每个任务在哪个
+    进程上执行：进程意外退出（如被系统因内存不足杀掉）时，只让该任务失败，
+    并重新启动一个进程补位。
+    """
+
+    # 进程连续多少次未完成任何任务就退出时不再重启（如模型无法加载）
+    MAX_START_FAILURES = 3
+
+    def __init__(self, processes=None, ort_threads=ORT_THREADS, model_name="u2net"):
+        self.ort_threads = max(1, ort_threads)
+        self.processes = processes or max(1, (os.cpu_count() or 1) // self.ort_threads)
+        self.model_name = model_name
+
+        self._ctx = mp.get_context("spawn")
+        self._queue = deque()   # 等待派发的任务
+        self._pending = {}      # 任务ID -> [Event, 错误信息]
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._closed = False
+        self._start_failures = 0
+        # 唤醒监听线程（有新任务或关闭时）
+        self._wake_r, self._wake_w = self._ctx.Pipe(duplex=False)
+        self._wake_lock = threading.Lock()
+
+        self._workers = [self._spawn() for _ in range(self.processes)]
+
+        self._listener = threading.Thread(target=self._collect, name="inference-pool", daemon=True)
+        self._listener.start()
+        # 解释器退出前关闭进程池，监听线程正常结束
+        atexit.register(self.close)
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        p = self._ctx.Process(
+            target=_worker_main,
+            args=(self.model_name, self.ort_threads, child_conn),
+            daemon=True
+        )
+        p.start()
+        child_conn.close()
+        return _Worker(p, parent_conn)
+
+    def _resolve(self, task_id, error=None):
+        """唤醒等待该任务的线程，error 为 None 表示成功"""
+        with self._lock:
+            waiter = self._pending.pop(task_id, None)
+        if waiter is not None:
+            waiter[1] = error
+            waiter[0].set()
+
+    def _dispatch(self):
+        """把排队的任务派发给空闲进程"""
+        if not self._workers:
+            # 进程反复启动失败，排队的任务全部报错
+            with self._lock:
+                queued = [task[0] for task in self._queue]
+                self._queue.clear()
+            for task_id in queued:
+                self._resolve(task_id, "推理进程无法启动")
+            return
+
+        for worker in self._workers:
+            if worker.task is not None:
+                continue
+            with self._lock:
+                if not self._queue:
+                    return
+                task = self._queue.popleft()
+            try:
+                worker.conn.send(task)
+                worker.task = task[0]
+            except OSError:
+                # 进程已退出，任务放回队首，由 _reap 处理该进程
+                with self._lock:
+                    self._queue.appendleft(task)
+
+    def _reap(self, worker):
+        """进程退出：让其正在处理的任务失败，并重启一个进程补位"""
+        worker.process.join()
+        worker.conn.close()
+        if worker.task is not None:
+            self._resolve(worker.task, f"推理进程意外退出（退出码 {worker.process.exitcode}）")
+        if worker.completed == 0:
+            self._start_failures += 1
+        else:
+            self._start_failures = 0
+
+        self._workers.remove(worker)
+        if self._start_failures < self.MAX_START_FAILURES:
+            self._workers.append(self._spawn())
+
+    def _collect(self):
+        """监听线程：派发任务、接收结果、处理意外退出的进程"""
+        while not self._closed:
+            self._dispatch()
+            conns = {w.conn: w for w in self._workers}
+            sentinels = {w.process.sentinel: w for w in self._workers}
+            ready = connection.wait(list(conns) + list(sentinels) + [self._wake_r])
+
+            for obj in ready:
+                if obj is self._wake_r:
+                    while self._wake_r.poll():
+                        self._wake_r.recv()
+                elif obj in conns:
+                    worker = conns[obj]
+                    try:
+                        task_id, error, timing = worker.conn.recv()
+                    except Exception:
+                        continue  # 进程已退出（可能只写了半条消息），随后由哨兵处理
+                    worker.task = None
+                    worker.completed += 1
+                    self._start_failures = 0
+                    if timing is not None and tracing.enabled():
+                        start, end, pid, tid = timing
+                        tracing.record("worker.predict", start, end, {"task": task_id},
+                                       pid=pid, tid=tid, process_name="推理进程")
+                    self._resolve(task_id, error)
+            for obj in ready:
+                worker = sentinels.get(obj)
+                if worker is not None and worker in self._workers:
+                    self._reap(worker)
+
+        # 关闭：通知进程退出，未完成的任务全部报错
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.conn.close()
+        with self._lock:
+            task_ids = list(self._pending)
+            self._queue.clear()
+        for task_id in task_ids:
+            self._resolve(task_id, "推理进程池已关闭")
+
+    def _wake(self):
+        with self._wake_lock:
+            try:
+                self._wake_w.send(None)
+            except OSError:
+                pass  # 进程池已关闭，任务已由监听线程报错
+
+    @traced("pool.predict")
+    def predict(self, img):
+        """
+        推理单张图片（线程安全，可由多个线程同时调用）
+
+        参数:
+            img: PIL图像
+
+        返回:
+            uint8 蒙版 (H, W)
+        """
+        shape = (img.height, img.width, 3)
+        src = shared_memory.SharedMemory(create=True, size=img.width * img.height * 3)
+        dst = shared_memory.SharedMemory(create=True, size=img.width * img.height)
+        try:
+            _copy_pixels(img, np.ndarray(shape, dtype=np.uint8, buffer=src.buf))
+
+            task_id = next(self._ids)
+            waiter = [threading.Event(), None]
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("推理进程池已关闭")
+                self._pending[task_id] = waiter
+                self._queue.append((task_id, src.name, dst.name, shape))
+            self._wake()
+
+            # 监听线程保证每个任务都会有结果：完成、出错、进程退出或进程池关闭
+            waiter[0].wait()
+            if waiter[1] is not None:
+                raise RuntimeError(waiter[1])
+
+            return np.ndarray(shape[:2], dtype=np.uint8, buffer=dst.buf).copy()
+        finally:
+            src.close()
+            src.unlink()
+            dst.close()
+            dst.unlink()
+
+    def close(self):
+        """关闭所有推理进程（等待监听线程结束）"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake()
+        self._listener.join()
+        self._wake_w.close()
+        self._wake_r.close()
@@ -0,0 +1,116 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from tracing import traced
+
+# ======================== 配置部分 ========================
+MATTE_DIR = os.environ.get(
+    "REPICBG_MATTE_DIR",
+    os.path.join(os.path.expanduser("~"), ".u2net", "mattes")
+)
+# REPICBG_MATTE_MMAP=1 时以未压缩 .npy 保存并以内存映射方式读取
+MATTE_MMAP = os.environ.get("REPICBG_MATTE_MMAP", "0") == "1"
+
+
+def content_hash(data):
+    """计算图片内容哈希（字节或文件路径）"""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        h.update(data)
+    else:
+        with open(data, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class MatteStore:
+    """
+    本地蒙版库
+
+    按 输入内容哈希 + 模型名 保存模型输出的原始蒙版（8位单通道）：默认存为
+    压缩的PNG，mmap=True 时存为 .npy 并以内存映射方式读取。换背景、换尺寸
+    重新导出时直接读取蒙版，无需加载模型。
+    """
+
+    def __init__(self, root=MATTE_DIR, mmap=MATTE_MMAP):
+        self.root = root
+        self.mmap = mmap
+        self._hashes = {}  # (路径, 修改时间, 大小) -> 内容哈希
+        self._lock = threading.Lock()
+
+    @traced("matte_store.hash")
+    def digest(self, source):
+        """获取图片内容哈希；文件路径按修改时间和大小记忆，避免重复读取"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return content_hash(source)
+
+        path = os.path.abspath(source)
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._hashes.get(key)
+        if digest is None:
+            digest = content_hash(path)
+            with self._lock:
+                if len(self._hashes) > 100000:
+                    self._hashes.clear()
+                self._hashes[key] = digest
+        return digest
+
+    def _path(self, digest, model, ext):
+        return os.path.join(self.root, model, digest[:2], digest + ext)
+
+    @traced("matte_store.read")
+    def get(self, digest, model):
+        """读取蒙版，不存在时返回 None"""
+        npy_path = self._path(digest, model, ".npy")
+        if os.path.exists(npy_path):
+            try:
+                return np.load(npy_path, mmap_mode="r" if self.mmap else None)
+            except (OSError, ValueError):
+                return None
+
+        png_path = self._path(digest, model, ".png")
+        if os.path.exists(png_path):
+            try:
+                with Image.open(png_path) as img:
+                    return np.asarray(img.convert("L"))
+            except OSError:
+                return None
+        return None
+
+    @traced("matte_store.write")
+    def put(self, digest, model, mask):
+        """保存蒙版（先写临时文件再改名，并发写入同一蒙版也不会损坏）"""
+        path = self._path(digest, model, ".npy" if self.mmap else ".png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+        with open(tmp_path, "wb") as f:
+            if self.mmap:
+                np.save(f, mask)
+            else:
+                Image.fromarray(mask, "L").save(f, format="PNG", optimize=False, compress_level=6)
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, source, model, compute):
+        """
+        读取蒙版，不存在时调用 compute() 计算并保存
+
+        参数:
+            source: 图片路径或字节（用于计算内容哈希）
+            model: 模型名
+            compute: 无参可调用对象，返回 uint8 蒙版
+        """
+        digest = self.digest(source)
+        mask = self.get(digest, model)
+        if mask is None:
+            mask = compute()
+            try:
+                self.put(digest, model, mask)
+            except OSError as e:
+                print(f"保存蒙版失败: {str(e)}")
+        return mask
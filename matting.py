@@ -0,0 +1,351 @@
+import io
+import numpy as np
+from PIL import Image, ImageOps
+from backgrounds import backdrop_for
+from tracing import traced
+from id_photo import PHOTO_SIZES, PHOTO_DPI, crop_to_size
+
+
+@traced("decode")
+def load_image(source):
+    """读取图片（路径/字节/文件对象/PIL图像），按EXIF方向校正并转为RGB"""
+    if isinstance(source, Image.Image):
+        img = source
+    elif isinstance(source, (bytes, bytearray)):
+        img = Image.open(io.BytesIO(source))
+    else:
+        img = Image.open(source)
+    img = ImageOps.exif_transpose(img)
+    return img.convert("RGB")
+
+
+@traced("predict")
+def predict_mask(session, img):
+    """
+    运行抠图模型
+
+    参数:
+        session: rembg 会话
+        img: RGB PIL图像
+
+    返回:
+        与原图同尺寸的 uint8 单通道蒙版 (H, W)
+    """
+    masks = session.predict(img)
+    return np.asarray(masks[0].convert("L"))
+
+
+@traced("composite")
+def composite(img, mask, bgcolor=None, backdrop=None):
+    """
+    按蒙版合成前景与背景（纯色和图片/渐变背景都是一次向量化的 alpha 混合）
+
+    参数:
+        img: RGB PIL图像
+        mask: uint8 蒙版 (H, W)
+        bgcolor: (R, G, B) 或 (R, G, B, A)；None 或 A=0 表示透明背景
+        backdrop: 可广播到 (H, W, 3) 的 uint8 背景数组，优先于 bgcolor
+
+    返回:
+        透明背景时为 RGBA 图像，否则为 RGB 图像
+    """
+    rgb = np.asarray(img.convert("RGB"))
+    if backdrop is None and (bgcolor is None or (len(bgcolor) == 4 and bgcolor[3] == 0)):
+        return Image.fromarray(np.dstack([rgb, mask]), "RGBA")
+
+    alpha = mask.astype(np.uint16)[..., None]
+    if backdrop is not None:
+        bg = backdrop.astype(np.uint16)
+    else:
+        bg = np.array(bgcolor[:3], dtype=np.uint16)
+    out = (rgb * alpha + bg * (255 - alpha) + 127) // 255
+    return Image.fromarray(out.astype(np.uint8), "RGB")
+
+
+def _box(x, radius):
+    """均值滤波（可分离实现）"""
+    from scipy import ndimage
+    return ndimage.uniform_filter(x, size=2 * radius + 1, mode="reflect")
+
+
+def _sample_bilinear(x, ys, xs, scale):
+    """在降采样数组 x 上，对原图坐标 (ys, xs) 做双线性采样"""
+    fy = np.clip((ys + 0.5) / scale - 0.5, 0, x.shape[0] - 1)
+    fx = np.clip((xs + 0.5) / scale - 0.5, 0, x.shape[1] - 1)
+    y0 = np.minimum(fy.astype(np.intp), x.shape[0] - 2) if x.shape[0] > 1 else np.zeros_like(ys)
+    x0 = np.minimum(fx.astype(np.intp), x.shape[1] - 2) if x.shape[1] > 1 else np.zeros_like(xs)
+    y1 = np.minimum(y0 + 1, x.shape[0] - 1)
+    x1 = np.minimum(x0 + 1, x.shape[1] - 1)
+    wy = (fy - y0).astype(np.float32)
+    wx = (fx - x0).astype(np.float32)
+    top = x[y0, x0] * (1 - wx) + x[y0, x1] * wx
+    bottom = x[y1, x0] * (1 - wx) + x[y1, x1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def _upsample_blocks(small, shape, scale):
+    """将降采样的布尔图按块放大回原图尺寸"""
+    rows = np.minimum(np.arange(shape[0]) // scale, small.shape[0] - 1)
+    cols = np.minimum(np.arange(shape[1]) // scale, small.shape[1] - 1)
+    return small[np.ix_(rows, cols)]
+
+
+@traced("refine_edges")
+def refine_edges(img, mask, radius=None, eps=1e-4, band=None):
+    """
+    快速边缘精修（替代 rembg 的 alpha_matting）
+
+    以原图灰度为引导对蒙版做快速引导滤波：窄带检测和滤波系数都在降采样图上
+    计算，只对蒙版边界两侧窄带内的像素用全分辨率引导图求值并写回，
+    主体和背景区域保持不变。
+
+    参数:
+        img: RGB PIL图像
+        mask: uint8 蒙版 (H, W)
+        radius: 引导滤波半径（原图像素），默认按模型输出分辨率估算
+        eps: 正则项，越小越贴合原图边缘
+        band: 精修窄带的半宽（原图像素），默认同 radius
+
+    返回:
+        精修后的 uint8 蒙版
+    """
+    from scipy import ndimage
+
+    h, w = mask.shape
+    # u2net 输出为 320x320，放大后边缘模糊宽度约为 max(h, w) / 320 像素
+    blur = max(h, w) / 320
+    radius = radius or max(4, int(2 * blur))
+    band = band or radius
+
+    # 在降采样图上计算，缩放倍数保证滤波半径不小于 2 个像素
+    scale = max(1, min(radius // 2, min(h, w) // 256))
+    r = max(1, radius // scale)
+    gray = img.convert("L")
+    small_mask = np.asarray(Image.fromarray(mask).reduce(scale))
+
+    # 边界窄带 = 膨胀 - 腐蚀
+    binary = small_mask >= 128
+    size = 2 * max(1, band // scale) + 1
+    edge = ndimage.maximum_filter(binary, size) & ~ndimage.minimum_filter(binary, size)
+    if not edge.any():
+        return mask
+
+    I = np.asarray(gray.reduce(scale), dtype=np.float32) / 255
+    P = small_mask.astype(np.float32) / 255
+
+    mean_I = _box(I, r)
+    mean_p = _box(P, r)
+    var_I = _box(I * I, r) - mean_I * mean_I
+    cov_Ip = _box(I * P, r) - mean_I * mean_p
+    a = cov_Ip / (var_I + eps)
+    b = mean_p - a * mean_I
+    mean_a = _box(a, r)
+    mean_b = _box(b, r)
+
+    # 窄带放大回原图坐标，只在窄带像素上用全分辨率引导图求值
+    ys, xs = np.nonzero(_upsample_blocks(edge, (h, w), scale))
+    guide = np.asarray(gray)[ys, xs].astype(np.float32) / 255
+    q = _sample_bilinear(mean_a, ys, xs, scale) * guide + _sample_bilinear(mean_b, ys, xs, scale)
+
+    out = mask.copy()
+    out[ys, xs] = np.clip(q * 255 + 0.5, 0, 255).astype(np.uint8)
+    return out
+
+
+def _paint_labels(out, labels, ids, scale, value, grow=0, protect=None):
+    """
+    把降采样标记图中指定编号的连通域按块放大后写入 out
+
+    每个连通域只在自己的包围盒内处理，开销与连通域大小成正比。
+    grow 为向外扩张的格数，protect 中为 True 的格子不被写入。
+    """
+    from scipy import ndimage
+
+    sh, sw = labels.shape
+    slices = ndimage.find_objects(labels)
+    for i in ids:
+        rows, cols = slices[i - 1]
+        y0, y1 = max(rows.start - grow, 0), min(rows.stop + grow, sh)
+        x0, x1 = max(cols.start - grow, 0), min(cols.stop + grow, sw)
+        region = labels[y0:y1, x0:x1] == i
+        if grow:
+            region = ndimage.binary_dilation(region, iterations=grow)
+        if protect is not None:
+            region &= ~protect[y0:y1, x0:x1]
+        target = out[y0 * scale:y1 * scale, x0 * scale:x1 * scale]
+        up = region.repeat(scale, axis=0).repeat(scale, axis=1)
+        target[up[:target.shape[0], :target.shape[1]]] = value
+
+
+@traced("clean_mask")
+def clean_mask(mask, threshold=0, min_area=0.0, fill_holes=False, max_hole=1.0):
+    """
+    蒙版后处理：置信度阈值、去除小连通域、填补空洞
+
+    连通域标记在降采样图上进行，只改写需要处理的连通域所在区域。
+
+    参数:
+        mask: uint8 蒙版 (H, W)
+        threshold: 低于该值的像素置为完全透明，0 表示不处理
+        min_area: 面积小于图片面积该百分比的前景连通域被去除（最大连通域始终保留），0 表示不处理
+        fill_holes: 是否填补前景内部的空洞
+        max_hole: 只填补面积小于图片面积该百分比的空洞，避免填上手臂与身体间的真实背景
+
+    返回:
+        处理后的 uint8 蒙版
+    """
+    if threshold > 0:
+        mask = np.where(mask < threshold, 0, mask).astype(np.uint8)
+    if min_area <= 0 and not fill_holes:
+        return mask
+
+    from scipy import ndimage
+
+    h, w = mask.shape
+    scale = max(1, min(h, w) // 1024)
+    small = np.asarray(Image.fromarray(mask).reduce(scale)) >= 128
+    cell_area = scale * scale
+    out = mask.copy()
+
+    if min_area > 0:
+        labels, count = ndimage.label(small)
+        if count > 1:
+            areas = np.bincount(labels.ravel())
+            areas[0] = 0
+            keep = areas * cell_area >= h * w * min_area / 100
+            keep[np.argmax(areas)] = True
+            removed = np.flatnonzero(~keep[1:]) + 1
+            if len(removed):
+                kept = keep[labels]
+                # 连同杂点的半透明边缘一起清除，但不碰保留的连通域
+                _paint_labels(out, labels, removed, scale, 0, grow=2, protect=kept)
+                small = kept
+
+    if fill_holes:
+        # 不与图像边界相连的背景连通域即为空洞
+        labels, count = ndimage.label(~small)
+        if count > 0:
+            areas = np.bincount(labels.ravel())
+            is_hole = areas * cell_area <= h * w * max_hole / 100
+            is_hole[0] = False
+            border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+            is_hole[np.unique(border)] = False
+            holes = np.flatnonzero(is_hole)
+            if len(holes):
+                _paint_labels(out, labels, holes, scale, 255, grow=1)
+
+    return out
+
+
+@traced("feather_mask")
+def feather_mask(mask, radius, tile=256):
+    """
+    边缘羽化：对蒙版做高斯模糊
+
+    只处理含有边缘的图块（及其相邻图块），纯前景/纯背景区域模糊后不变，直接跳过。
+    """
+    from PIL import ImageFilter
+    if radius <= 0:
+        return mask
+
+    h, w = mask.shape
+    th, tw = -(-h // tile), -(-w // tile)
+    padded = np.pad(mask, ((0, th * tile - h), (0, tw * tile - w)), mode="edge")
+    blocks = padded.reshape(th, tile, tw, tile)
+    lo, hi = blocks.min(axis=(1, 3)), blocks.max(axis=(1, 3))
+    busy = lo != hi
+    # 边缘正好落在图块边界上时，两侧图块各自都是纯色，但取值与相邻图块不同
+    busy[1:] |= lo[1:] != lo[:-1]
+    busy[:-1] |= lo[1:] != lo[:-1]
+    busy[:, 1:] |= lo[:, 1:] != lo[:, :-1]
+    busy[:, :-1] |= lo[:, 1:] != lo[:, :-1]
+
+    pad = int(3 * radius) + 1
+    # 模糊半径内的图块也会受到边缘影响（半径大于图块时要多扩几圈）
+    grown = busy
+    for _ in range(-(-pad // tile)):
+        grown = grown.copy()
+        grown[1:] |= grown[:-1].copy()
+        grown[:-1] |= grown[1:].copy()
+        grown[:, 1:] |= grown[:, :-1].copy()
+        grown[:, :-1] |= grown[:, 1:].copy()
+
+    blur = ImageFilter.GaussianBlur(radius)
+    out = mask.copy()
+    for ty, tx in zip(*np.nonzero(grown)):
+        y0, x0 = ty * tile, tx * tile
+        y1, x1 = min(y0 + tile, h), min(x0 + tile, w)
+        wy0, wx0 = max(y0 - pad, 0), max(x0 - pad, 0)
+        window = Image.fromarray(mask[wy0:min(y1 + pad, h), wx0:min(x1 + pad, w)]).filter(blur)
+        out[y0:y1, x0:x1] = np.asarray(window)[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+    return out
+
+
+@traced("cutout")
+def cutout(img, mask, bgcolor=None, refine=False, threshold=0, min_area=0.0,
+           fill_holes=False, feather=0, background=None, photo_size=None):
+    """
+    蒙版处理 + 合成
+
+    参数:
+        img: RGB PIL图像
+        mask: 模型输出的 uint8 蒙版
+        bgcolor: 背景颜色，含义同 composite
+        refine: 是否做边缘精修
+        threshold, min_area, fill_holes: 蒙版后处理参数，见 clean_mask
+        feather: 边缘羽化半径（像素），0 表示不羽化
+        background: 图片/渐变背景描述（见 backgrounds），优先于 bgcolor
+        photo_size: 证件照尺寸（id_photo.PHOTO_SIZES 的键），None 表示保持原图尺寸
+
+    返回:
+        合成后的PIL图像
+    """
+    mask = clean_mask(mask, threshold, min_area, fill_holes)
+    if photo_size is not None:
+        # 先按人像位置裁剪缩放，之后的精修、合成和编码只处理输出尺寸的像素
+        _, width, height = PHOTO_SIZES[photo_size]
+        img, mask = crop_to_size(img, mask, (width, height))
+    if refine:
+        mask = refine_edges(img, mask)
+    mask = feather_mask(mask, feather)
+    backdrop = backdrop_for(background, img.size) if background is not None else None
+    out = composite(img, mask, bgcolor, backdrop)
+    if photo_size is not None:
+        out.info["dpi"] = (PHOTO_DPI, PHOTO_DPI)
+    return out
+
+
+@traced("encode_png")
+def encode_png(img):
+    """将图像编码为PNG字节（图像带有 dpi 信息时一并写入，便于按尺寸打印）"""
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", dpi=img.info.get("dpi"))
+    return buf.getvalue()
+
+
+# 重新导出支持的格式 -> 文件扩展名
+EXPORT_FORMATS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+
+@traced("encode")
+def encode_image(img, fmt="PNG"):
+    """
+    按指定格式编码图像
+
+    参数:
+        img: 合成后的图像（RGB 或 RGBA）
+        fmt: EXPORT_FORMATS 中的格式；JPEG 不支持透明，透明背景会铺白底
+    """
+    if fmt == "PNG":
+        return encode_png(img)
+    dpi = img.info.get("dpi")
+    if fmt == "JPEG" and img.mode == "RGBA":
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        img = flat
+    options = {"quality": 95 if fmt == "JPEG" else 90}
+    if dpi:
+        options["dpi"] = dpi
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **options)
+    return buf.getvalue()
@@ -0,0 +1,120 @@
+import io
+import queue
+import threading
+from PIL import Image
+from image_store import fit_size
+from tracing import traced
+
+
+@traced("scale_to_fit")
+def scale_to_fit(img, max_width, max_height):
+    """
+    缩放到画布尺寸：先用 Image.reduce 做整数倍快速缩小，再做一次 LANCZOS
+
+    参数:
+        img: PIL图像或PNG字节
+        max_width, max_height: 画布尺寸
+
+    返回:
+        缩放后的PIL图像（RGB 或 RGBA，可直接转为 PhotoImage）
+    """
+    if isinstance(img, (bytes, bytearray)):
+        img = Image.open(io.BytesIO(img))
+        img.load()
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+    size = fit_size(img.width, img.height, max_width, max_height)
+    factor = min(img.width // size[0], img.height // size[1]) // 2
+    if factor > 1:
+        img = img.reduce(factor)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+    return img
+
+
+class PreviewRenderer:
+    """
+    后台预览渲染线程
+
+    缩放等耗时操作在后台线程完成，结果交回Tk主线程绘制。每个画布（slot）
+    只保留最新一次请求：尚未开始的旧请求被直接替换，已过期的结果被丢弃。
+    """
+
+    def __init__(self, widget, poll_interval=15):
+        self.widget = widget
+        self.poll_interval = poll_interval
+        self._jobs = {}        # slot -> (序号, 任务, 回调)，尚未开始的请求
+        self._latest = {}      # slot -> 最新请求序号
+        self._seq = 0
+        self._outstanding = 0  # 已提交但结果尚未交回的请求数
+        self._polling = False
+        self._cond = threading.Condition()
+        self._done = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def request(self, slot, job, callback):
+        """
+        提交渲染请求（在主线程调用）
+
+        参数:
+            slot: 画布标识
+            job: 无参可调用对象，在后台线程执行，返回PIL图像
+            callback: callback(img, error)，在主线程执行
+        """
+        with self._cond:
+            self._seq += 1
+            self._latest[slot] = self._seq
+            if slot not in self._jobs:
+                self._outstanding += 1
+            self._jobs[slot] = (self._seq, job, callback)
+            self._cond.notify()
+
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_interval, self._drain)
+
+    def cancel(self, slot):
+        """丢弃某个画布尚未交回的请求"""
+        with self._cond:
+            self._seq += 1
+            self._latest[slot] = self._seq
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                slot = next(iter(self._jobs))
+                seq, job, callback = self._jobs.pop(slot)
+
+            img, error = None, None
+            try:
+                img = job()
+            except Exception as e:
+                error = e
+            self._done.put((slot, seq, img, error, callback))
+
+    def _drain(self):
+        """主线程：取回渲染结果并回调"""
+        while True:
+            try:
+                slot, seq, img, error, callback = self._done.get_nowait()
+            except queue.Empty:
+                break
+            with self._cond:
+                self._outstanding -= 1
+                current = self._latest.get(slot) == seq
+            if current:
+                try:
+                    callback(img, error)
+                except Exception as e:
+                    # 回调出错（如画布已销毁）不能中断轮询，否则之后的预览都不会再显示
+                    print(f"预览回调失败: {str(e)}")
+
+        with self._cond:
+            busy = self._outstanding > 0
+        if busy:
+            self.widget.after(self.poll_interval, self._drain)
+        else:
+            self._polling = False
@@ -1,21 +1,34 @@
 import os
 import sys
-import io
 import tkinter as tk
 from tkinter import ttk, filedialog, colorchooser, messagebox
 from PIL import Image, ImageTk
+import numpy as np
 import threading
 import requests
 from tkinterdnd2 import TkinterDnD, DND_FILES
 import sv_ttk
 from colorpicker import pick_screen_color
+from scheduler import PriorityScheduler, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from matting import predict_mask, cutout, encode_png, encode_image, EXPORT_FORMATS
+from inference_pool import InferencePool, INFERENCE_WORKERS, ORT_THREADS
+from watcher import HotFolderWatcher, process_batch
+from image_store import ImageStore
+from renderer import PreviewRenderer, scale_to_fit
+from backgrounds import GRADIENT_DIRECTIONS, gradient_spec, image_spec, backdrop_for
+from matte_store import MatteStore
+from id_photo import PHOTO_SIZES
+from adaptive import AdaptiveBatchRunner
+import tracing
 
 # ======================== 配置部分 ========================
 MODEL_URL = "https://github.com/danielgatis/rembg/releases/download/v0.0.0/u2net.onnx"
 MODEL_NAME = "u2net.onnx"
+MODEL_KEY = os.path.splitext(MODEL_NAME)[0]  # rembg 会话名，也用于区分已存蒙版
 MODEL_DIR = os.path.join(os.path.expanduser("~"), ".u2net")
 os.makedirs(MODEL_DIR, exist_ok=True)
 MODEL_PATH = os.path.join(MODEL_DIR, MODEL_NAME)
+BATCH_WINDOW = 4  # 批处理同时排队的任务数，越小交互请求插队越快
 
 # ======================== 工具函数 ========================
 def download_file(url, save_path):
@@ -47,12 +60,6 @@ def check_model():
     if not os.path.exists(MODEL_PATH):
         print("未找到模型文件，开始下载...")
         if not download_file(MODEL_URL, MODEL_PATH):
-            messagebox.showerror(
-                "模型下载失败",
-                f"无法下载AI模型文件\n"
-                f"请手动下载: {MODEL_URL}\n"
-                f"并保存到: {MODEL_PATH}"
-            )
             return False
     return True
 
@@ -73,14 +80,26 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         self.image_files = []
         self.current_image = None
         self.session = None
+        self.pool = None  # 多进程推理池（REPICBG_WORKERS>0 时启用）
+        self.watcher = None  # 热文件夹监视器
+        self.image_store = ImageStore()  # 缩略图、预览、抠图共用的解码缓存
+        self.matte_store = MatteStore()  # 已计算蒙版的本地存储
+        self.model_lock = threading.Lock()
+        self.model_error = None  # 模型加载失败的原因，本次操作内不再重试
+        self.result_source = None  # 当前效果图（用于窗口缩放时重新渲染）
+        self.resize_job = None
         self.view_mode = "thumbnail"  # 默认缩略图模式
         self.recent_colors = [(255, 255, 255)]  # 最近5个背景色
+        self.gradient_color = (67, 142, 219)  # 渐变背景的终止色（起始色为背景颜色）
+        self.backdrop_path = None  # 图片背景文件
 
         # 初始化UI
         self.setup_ui()
+        self.renderer = PreviewRenderer(self)  # 后台预览渲染
 
-        # 初始化AI模型
-        self.init_model()
+        # 交互与批处理共用的推理队列，每个推理进程对应一个调度线程
+        # AI模型在第一次需要推理时加载（见 init_model）
+        self.scheduler = PriorityScheduler(workers=max(1, INFERENCE_WORKERS))
 
         # 窗口居中
         self.center_window()
@@ -95,16 +114,42 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         self.geometry(f"{width}x{height}+{x}+{y}")
 
     def init_model(self):
-        """初始化AI模型"""
-        if not check_model():
-            return
+        """
+        初始化AI模型（首次需要推理时才加载，已存蒙版命中时不加载）
+
+        加载失败时记住原因，之后的任务直接报错，不会每张图片都重新下载；
+        每次开始新的抠图/批处理操作时清除（见 reset_model_error）。
+        """
+        with self.model_lock:
+            if self.model_ready():
+                return
+            if self.model_error is not None:
+                raise RuntimeError(self.model_error)
+
+            if not check_model():
+                self.model_error = (
+                    f"无法下载AI模型文件\n"
+                    f"请手动下载: {MODEL_URL}\n"
+                    f"并保存到: {MODEL_PATH}"
+                )
+                raise RuntimeError(self.model_error)
 
-        try:
-            from rembg import new_session
-            self.session = new_session("u2net")
-            print("AI模型加载成功")
-        except Exception as e:
-            messagebox.showerror("AI加载失败", f"无法加载AI模型:\n{str(e)}")
+            try:
+                if INFERENCE_WORKERS > 0:
+                    self.pool = InferencePool(INFERENCE_WORKERS, ORT_THREADS, MODEL_KEY)
+                    print(f"AI推理进程池已启动: {self.pool.processes} 个进程 x {self.pool.ort_threads} 线程")
+                else:
+                    from rembg import new_session
+                    self.session = new_session(MODEL_KEY)
+                    print("AI模型加载成功")
+            except Exception as e:
+                self.model_error = f"无法加载AI模型:\n{str(e)}"
+                raise RuntimeError(self.model_error)
+
+    def reset_model_error(self):
+        """开始新的操作前清除上次的加载失败记录（用户可能已手动放好模型文件）"""
+        with self.model_lock:
+            self.model_error = None
 
     def toggle_theme(self):
         """切换明亮/黑暗模式"""
@@ -239,6 +284,10 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         )
         self.dst_canvas.pack(fill=tk.BOTH, expand=True)
 
+        # 窗口缩放时重新渲染对比视图
+        self.src_container.bind("<Configure>", self.on_compare_resize)
+        self.dst_container.bind("<Configure>", self.on_compare_resize)
+
         # ========== 右侧控制面板 ==========
         right_frame = ttk.LabelFrame(self.paned_main, text="工具面板", padding=10)
         right_frame.pack_propagate(False)
@@ -274,6 +323,64 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         ttk.Radiobutton(bg_type_frame, text="透明背景", variable=self.bg_type,
                         value="transparent", command=self.update_bg_preview).pack(side=tk.LEFT)
 
+        bg_type_frame2 = ttk.Frame(bg_frame)
+        bg_type_frame2.pack(fill=tk.X, pady=(5, 0))
+        ttk.Radiobutton(bg_type_frame2, text="渐变背景", variable=self.bg_type,
+                        value="gradient", command=self.update_bg_preview).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Radiobutton(bg_type_frame2, text="图片背景", variable=self.bg_type,
+                        value="image", command=self.update_bg_preview).pack(side=tk.LEFT)
+
+        # 渐变与图片背景设置
+        gradient_frame = ttk.Frame(bg_frame)
+        gradient_frame.pack(fill=tk.X, pady=(8, 0))
+        ttk.Button(gradient_frame, text="渐变终止色",
+                   command=self.choose_gradient_color).pack(side=tk.LEFT)
+        self.gradient_direction = tk.StringVar(value=GRADIENT_DIRECTIONS["vertical"])
+        direction_box = ttk.Combobox(gradient_frame, textvariable=self.gradient_direction,
+                                     values=list(GRADIENT_DIRECTIONS.values()),
+                                     state="readonly", width=8)
+        direction_box.pack(side=tk.RIGHT)
+        direction_box.bind("<<ComboboxSelected>>", lambda e: self.update_bg_preview())
+
+        ttk.Button(bg_frame, text="选择背景图片",
+                   command=self.choose_backdrop_image).pack(fill=tk.X, pady=(8, 0))
+        self.backdrop_label = ttk.Label(bg_frame, text="未选择背景图片", foreground="gray")
+        self.backdrop_label.pack(anchor=tk.W, pady=(2, 0))
+
+        # 抠图选项
+        options_frame = ttk.LabelFrame(right_frame, text="抠图选项", padding=(15, 10))
+        options_frame.pack(fill=tk.X, pady=(0, 10))
+
+        self.refine_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="边缘精修（发丝更自然）",
+                        variable=self.refine_var).pack(anchor=tk.W)
+
+        # 蒙版后处理
+        self.remove_islands_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="去除背景杂点",
+                        variable=self.remove_islands_var).pack(anchor=tk.W, pady=(5, 0))
+        self.fill_holes_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="填补衣物空洞",
+                        variable=self.fill_holes_var).pack(anchor=tk.W, pady=(5, 0))
+
+        self.threshold_var = tk.IntVar(value=0)
+        self.feather_var = tk.IntVar(value=0)
+        for text, var, upper in (("置信度阈值:", self.threshold_var, 254),
+                                 ("边缘羽化(像素):", self.feather_var, 20)):
+            row = ttk.Frame(options_frame)
+            row.pack(fill=tk.X, pady=(5, 0))
+            ttk.Label(row, text=text).pack(side=tk.LEFT)
+            ttk.Spinbox(row, from_=0, to=upper, textvariable=var, width=5).pack(side=tk.RIGHT)
+
+        # 证件照尺寸：按人像位置自动裁剪缩放
+        row = ttk.Frame(options_frame)
+        row.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(row, text="输出尺寸:").pack(side=tk.LEFT)
+        self.photo_size_var = tk.StringVar(value="原图尺寸")
+        ttk.Combobox(row, textvariable=self.photo_size_var,
+                     values=["原图尺寸"] + [label for label, _, _ in PHOTO_SIZES.values()],
+                     state="readonly", width=14).pack(side=tk.RIGHT)
+
         # 处理操作
         process_frame = ttk.LabelFrame(right_frame, text="图片处理", padding=(15, 10))
         process_frame.pack(fill=tk.X, pady=10)
@@ -286,6 +393,10 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
                                       command=self.batch_process)
         self.replace_btn.pack(fill=tk.X, pady=8)
 
+        self.watch_btn = ttk.Button(process_frame, text="监视文件夹",
+                                    command=self.toggle_watch)
+        self.watch_btn.pack(fill=tk.X, pady=8)
+
         # 导出操作
         export_frame = ttk.LabelFrame(right_frame, text="导出选项", padding=(15, 10))
         export_frame.pack(fill=tk.X, pady=(0, 10))
@@ -294,6 +405,27 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
                                      command=self.batch_export)
         self.export_btn.pack(fill=tk.X, pady=8)
 
+        self.reexport_btn = ttk.Button(export_frame, text="按已存蒙版重新导出",
+                                       command=self.reexport_from_mattes)
+        self.reexport_btn.pack(fill=tk.X, pady=8)
+
+        row = ttk.Frame(export_frame)
+        row.pack(fill=tk.X)
+        ttk.Label(row, text="重新导出格式:").pack(side=tk.LEFT)
+        self.export_format_var = tk.StringVar(value="PNG")
+        ttk.Combobox(row, textvariable=self.export_format_var, values=list(EXPORT_FORMATS),
+                     state="readonly", width=8).pack(side=tk.RIGHT)
+
+        # 菜单栏
+        menubar = tk.Menu(self)
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        self.trace_var = tk.BooleanVar(value=tracing.enabled())
+        tools_menu.add_checkbutton(label="记录性能追踪", variable=self.trace_var,
+                                   command=self.toggle_tracing)
+        tools_menu.add_command(label="导出性能追踪...", command=self.export_trace)
+        menubar.add_cascade(label="工具", menu=tools_menu)
+        self.configure(menu=menubar)
+
         # 状态栏
         status_frame = ttk.Frame(self)
         status_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=5)
@@ -320,7 +452,9 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         self.color_btn.configure(style="Accent.TButton")
         self.cutout_btn.configure(style="Large.TButton")
         self.replace_btn.configure(style="Large.TButton")
+        self.watch_btn.configure(style="Large.TButton")
         self.export_btn.configure(style="Large.TButton")
+        self.reexport_btn.configure(style="Large.TButton")
 
     # ======================== 功能方法 ========================
     def set_view_mode(self, mode):
@@ -373,6 +507,10 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         """清空文件列表"""
         self.image_files = []
         self.update_file_list()
+        self.current_image = None
+        self.result_source = None
+        self.renderer.cancel("src")
+        self.renderer.cancel("dst")
         self.src_canvas.delete("all")
         self.dst_canvas.delete("all")
         self.status_var.set("已清空文件列表")
@@ -410,8 +548,7 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         # 添加新缩略图
         for i, img_path in enumerate(self.image_files):
             try:
-                img = Image.open(img_path)
-                img.thumbnail((80, 80))
+                img = self.image_store.get_thumbnail(img_path, 80)
                 photo = ImageTk.PhotoImage(img)
 
                 frame = ttk.Frame(self.thumbnail_container)
@@ -465,63 +602,70 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
             self.current_image = self.image_files[index]
             self.show_preview(self.current_image)
 
-    def show_preview(self, image_path):
-        """显示图片预览（原图和效果图）"""
-        try:
-            img = Image.open(image_path)
-
-            # 计算适合画布的尺寸
-            canvas_width = self.src_container.winfo_width() - 20
-            canvas_height = self.src_container.winfo_height() - 20
-
-            # 保持宽高比缩放
-            img_ratio = img.width / img.height
-            canvas_ratio = canvas_width / canvas_height
-
-            if img_ratio > canvas_ratio:
-                new_width = min(img.width, canvas_width)
-                new_height = int(new_width / img_ratio)
-            else:
-                new_height = min(img.height, canvas_height)
-                new_width = int(new_height * img_ratio)
-
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            self.src_photo = ImageTk.PhotoImage(img)
-
-            self.src_canvas.delete("all")
-            x = (self.src_container.winfo_width() - new_width) // 2
-            y = (self.src_container.winfo_height() - new_height) // 2
-            self.src_canvas.create_image(x, y, anchor=tk.NW, image=self.src_photo)
+    def show_preview(self, image_path, keep_result=False):
+        """显示图片预览（原图和效果图），缩放在后台渲染线程中完成"""
+        # 计算适合画布的尺寸
+        canvas_width = self.src_container.winfo_width() - 20
+        canvas_height = self.src_container.winfo_height() - 20
+
+        def draw(img, error):
+            if error is not None:
+                messagebox.showerror("图片加载错误", f"无法加载图片:\n{str(error)}")
+                return
+            self.draw_on_canvas(self.src_canvas, self.src_container, img, "src_photo")
+
+        # 保持宽高比缩放（从共享缓存的预览金字塔中取图）
+        self.renderer.request(
+            "src",
+            lambda: self.image_store.get_preview(image_path, canvas_width, canvas_height),
+            draw
+        )
 
+        if not keep_result:
             # 效果区清空
+            self.result_source = None
+            self.renderer.cancel("dst")
             self.dst_canvas.delete("all")
-        except Exception as e:
-            messagebox.showerror("图片加载错误", f"无法加载图片:\n{str(e)}")
 
-    def show_result(self, result_img):
-        """显示效果图"""
+    def show_result(self, result):
+        """显示效果图（result 为PIL图像或PNG字节，解码和缩放在后台完成）"""
+        self.result_source = result
+
         # 计算适合画布的尺寸
         canvas_width = self.dst_container.winfo_width() - 20
         canvas_height = self.dst_container.winfo_height() - 20
 
-        # 保持宽高比缩放
-        img_ratio = result_img.width / result_img.height
-        canvas_ratio = canvas_width / canvas_height
-
-        if img_ratio > canvas_ratio:
-            new_width = min(result_img.width, canvas_width)
-            new_height = int(new_width / img_ratio)
-        else:
-            new_height = min(result_img.height, canvas_height)
-            new_width = int(new_height * img_ratio)
-
-        result_img = result_img.resize((new_width, new_height), Image.LANCZOS)
-        self.dst_photo = ImageTk.PhotoImage(result_img)
-
-        self.dst_canvas.delete("all")
-        x = (self.dst_container.winfo_width() - new_width) // 2
-        y = (self.dst_container.winfo_height() - new_height) // 2
-        self.dst_canvas.create_image(x, y, anchor=tk.NW, image=self.dst_photo)
+        def draw(img, error):
+            if error is not None:
+                messagebox.showerror("图片显示错误", f"无法显示效果图:\n{str(error)}")
+                return
+            self.draw_on_canvas(self.dst_canvas, self.dst_container, img, "dst_photo")
+
+        self.renderer.request("dst", lambda: scale_to_fit(result, canvas_width, canvas_height), draw)
+
+    def draw_on_canvas(self, canvas, container, img, attr):
+        """将渲染好的图像居中绘制到画布（PhotoImage 须在主线程创建）"""
+        photo = ImageTk.PhotoImage(img)
+        setattr(self, attr, photo)
+
+        canvas.delete("all")
+        x = (container.winfo_width() - img.width) // 2
+        y = (container.winfo_height() - img.height) // 2
+        canvas.create_image(x, y, anchor=tk.NW, image=photo)
+
+    def on_compare_resize(self, event):
+        """对比视图尺寸变化：去抖后按新尺寸重新渲染"""
+        if self.resize_job is not None:
+            self.after_cancel(self.resize_job)
+        self.resize_job = self.after(150, self.rerender_compare)
+
+    def rerender_compare(self):
+        """按当前画布尺寸重新渲染原图与效果图"""
+        self.resize_job = None
+        if self.current_image:
+            self.show_preview(self.current_image, keep_result=True)
+        if self.result_source is not None:
+            self.show_result(self.result_source)
 
     def update_recent_colors(self):
         """更新最近使用的颜色预览"""
@@ -540,9 +684,7 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
     def set_bg_color(self, color):
         """设置背景颜色"""
         self.bg_color = color
-        hex_color = '#%02x%02x%02x' % color
-        self.color_preview.delete("all")
-        self.color_preview.create_rectangle(0, 0, 40, 40, fill=hex_color, outline="")
+        self.update_bg_preview()
 
         # 更新最近颜色列表
         if color not in self.recent_colors:
@@ -567,6 +709,13 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
             self.transparent_bg = ImageTk.PhotoImage(bg)
             self.color_preview.delete("all")
             self.color_preview.create_image(0, 0, anchor=tk.NW, image=self.transparent_bg)
+        elif self.current_background() is not None:
+            # 显示渐变/图片背景
+            bg = Image.fromarray(np.ascontiguousarray(np.broadcast_to(
+                backdrop_for(self.current_background(), (40, 40)), (40, 40, 3))))
+            self.backdrop_preview = ImageTk.PhotoImage(bg)
+            self.color_preview.delete("all")
+            self.color_preview.create_image(0, 0, anchor=tk.NW, image=self.backdrop_preview)
         else:
             # 显示纯色背景
             hex_color = '#%02x%02x%02x' % self.bg_color
@@ -588,34 +737,160 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
             if color[0]:
                 self.set_bg_color(tuple(map(int, color[0])))
 
+    def choose_gradient_color(self):
+        """选择渐变背景的终止色"""
+        color = colorchooser.askcolor(title="选择渐变终止色", initialcolor=self.gradient_color)
+        if color[0]:
+            self.gradient_color = tuple(map(int, color[0]))
+            self.bg_type.set("gradient")
+            self.update_bg_preview()
+
+    def choose_backdrop_image(self):
+        """选择背景图片"""
+        path = filedialog.askopenfilename(
+            title="选择背景图片",
+            filetypes=[("图片文件", "*.jpg;*.jpeg;*.png;*.bmp")]
+        )
+        if path:
+            self.backdrop_path = path
+            self.backdrop_label.configure(text=os.path.basename(path))
+            self.bg_type.set("image")
+            self.update_bg_preview()
+
+    def current_bgcolor(self):
+        """当前背景设置对应的 RGBA/RGB 颜色"""
+        return (255, 255, 255, 0) if self.bg_type.get() == "transparent" else self.bg_color
+
+    def current_background(self):
+        """当前的渐变/图片背景描述，纯色或透明背景时为 None"""
+        bg_type = self.bg_type.get()
+        if bg_type == "gradient":
+            direction = next(key for key, label in GRADIENT_DIRECTIONS.items()
+                             if label == self.gradient_direction.get())
+            return gradient_spec(self.bg_color, self.gradient_color, direction)
+        if bg_type == "image" and self.backdrop_path:
+            try:
+                return image_spec(self.backdrop_path)
+            except OSError:
+                return None
+        return None
+
+    def check_background(self):
+        """选择了图片背景却没有可用的背景图片时提示并返回 False（桌面版与网页版一致：不处理）"""
+        if self.bg_type.get() != "image":
+            return True
+        if self.backdrop_path and os.path.isfile(self.backdrop_path):
+            return True
+        messagebox.showwarning("操作提示", "请先选择背景图片，或改用其他背景类型!")
+        return False
+
+    def current_photo_size(self):
+        """当前证件照尺寸（PHOTO_SIZES 的键），原图尺寸时返回 None"""
+        return next((key for key, (label, _, _) in PHOTO_SIZES.items()
+                     if label == self.photo_size_var.get()), None)
+
+    def int_option(self, var, default=0):
+        """读取数值输入框，内容无效时返回默认值"""
+        try:
+            return max(0, int(var.get()))
+        except (tk.TclError, ValueError):
+            return default
+
+    def current_settings(self):
+        """当前抠图与背景设置（作为 matting.cutout 的参数）"""
+        return {
+            "bgcolor": self.current_bgcolor(),
+            "refine": self.refine_var.get(),
+            "threshold": self.int_option(self.threshold_var),
+            "min_area": 0.5 if self.remove_islands_var.get() else 0.0,
+            "fill_holes": self.fill_holes_var.get(),
+            "feather": self.int_option(self.feather_var),
+            "background": self.current_background(),
+            "photo_size": self.current_photo_size(),
+        }
+
+    def result_key(self, img_path, settings):
+        """结果缓存键：文件路径 + 修改时间 + 处理设置"""
+        return (os.path.abspath(img_path), os.path.getmtime(img_path), tuple(sorted(settings.items())))
+
+    def model_ready(self):
+        """模型（或推理进程池）是否可用"""
+        return self.session is not None or self.pool is not None
+
+    def predict_mask(self, img):
+        """计算人像蒙版，启用进程池时交给子进程"""
+        self.init_model()
+        if self.pool is not None:
+            return self.pool.predict(img)
+        return predict_mask(self.session, img)
+
+    def cutout_bytes(self, img_path, settings, keep_decoded=False):
+        """对单张图片执行抠图，返回PNG字节"""
+        img = self.image_store.get(img_path, keep=keep_decoded)
+        mask = self.matte_store.get_or_compute(img_path, MODEL_KEY, lambda: self.predict_mask(img))
+        return encode_png(cutout(img, mask, **settings))
+
+    def submit_cutout(self, img_path, settings, priority):
+        """将抠图任务提交到共享调度器"""
+        queued = tracing.now()
+
+        def job():
+            tracing.record("queue_wait", queued, tracing.now())
+            with tracing.span("cutout_image", path=img_path, priority=priority):
+                return self.cutout_bytes(img_path, settings, priority == PRIORITY_INTERACTIVE)
+
+        return self.scheduler.submit(self.result_key(img_path, settings), job, priority)
+
+    def wait_future(self, future, callback, interval=30):
+        """在主线程中轮询任务，完成后回调"""
+        if future.done():
+            callback(future)
+        else:
+            self.after(interval, self.wait_future, future, callback, interval)
+
     def auto_cutout(self):
         """自动抠人像"""
-        if not self.current_image or not self.session:
+        if not self.current_image:
             messagebox.showwarning("操作提示", "请先选择图片!")
             return
+        if not self.check_background():
+            return
 
+        img_path = self.current_image
+        self.reset_model_error()
+        started = tracing.now()
         try:
-            from rembg import remove
-            with open(self.current_image, "rb") as f:
-                img_bytes = f.read()
-
-            result = remove(
-                img_bytes,
-                session=self.session,
-                bgcolor=(255, 255, 255, 0) if self.bg_type.get() == "transparent" else self.bg_color
-            )
-
-            result_img = Image.open(io.BytesIO(result))
-            self.show_result(result_img)
-            self.status_var.set("人像抠图完成")
+            future = self.submit_cutout(img_path, self.current_settings(), PRIORITY_INTERACTIVE)
         except Exception as e:
             messagebox.showerror("处理错误", f"人像抠图失败:\n{str(e)}")
+            return
+
+        def on_done(fut):
+            try:
+                result = fut.result()
+            except Exception as e:
+                messagebox.showerror("处理错误", f"人像抠图失败:\n{str(e)}")
+                return
+            # 从点击到拿到结果的整体耗时（含排队）
+            tracing.record("auto_cutout", started, tracing.now(), {"path": img_path})
+            # 等待期间用户已切换到其他图片
+            if img_path != self.current_image:
+                return
+            with tracing.span("show_result"):
+                self.show_result(result)
+            self.status_var.set("人像抠图完成")
+
+        if not future.done():
+            self.status_var.set("正在抠图...")
+        self.wait_future(future, on_done)
 
     def batch_process(self):
         """批量替换背景"""
-        if not self.image_files or not self.session:
+        if not self.image_files:
             messagebox.showwarning("操作提示", "请先添加图片!")
             return
+        if not self.check_background():
+            return
 
         output_dir = filedialog.askdirectory(title="选择输出文件夹")
         if not output_dir:
@@ -624,39 +899,144 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         self.progress["maximum"] = len(self.image_files)
         self.progress["value"] = 0
 
-        def worker():
-            from rembg import remove
+        image_files = list(self.image_files)
+        settings = self.current_settings()
+        self.reset_model_error()
 
-            for i, img_path in enumerate(self.image_files, 1):
-                try:
-                    filename = os.path.basename(img_path)
-                    name, ext = os.path.splitext(filename)
-                    output_path = os.path.join(output_dir, f"{name}_processed{ext}")
+        completed = [0]
+        failed = []
 
-                    with open(img_path, "rb") as f:
-                        result = remove(
-                            f.read(),
-                            session=self.session,
-                            bgcolor=(255, 255, 255, 0) if self.bg_type.get() == "transparent" else self.bg_color
-                        )
+        def finish(index, img_path, future):
+            filename = os.path.basename(img_path)
+            completed[0] += 1
+            try:
+                name, ext = os.path.splitext(filename)
+                output_path = os.path.join(output_dir, f"{name}_processed{ext}")
 
+                result = future.result()
+                with tracing.span("write_output", path=output_path):
                     with open(output_path, "wb") as f:
                         f.write(result)
 
-                    # 更新进度
-                    self.progress["value"] = i
-                    self.status_var.set(f"处理中: {i}/{len(self.image_files)} - {filename}")
+            except Exception as e:
+                print(f"处理 {img_path} 失败: {str(e)}")
+                failed.append(filename)
+                # 模型无法加载时其余图片也无法处理，不再继续提交
+                if self.model_error is not None:
+                    runner.stop()
 
-                except Exception as e:
-                    print(f"处理 {img_path} 失败: {str(e)}")
+            # 更新进度
+            self.progress["value"] = completed[0]
+            self.status_var.set(f"处理中: {completed[0]}/{len(image_files)} - {filename}")
+
+        def worker():
+            self.status_var.set("正在读取图片尺寸...")
+            with tracing.span("batch_process", count=len(image_files)):
+                runner.run(image_files, finish)
 
             # 处理完成
-            self.status_var.set(f"批量处理完成! 共处理 {len(self.image_files)} 张图片")
-            messagebox.showinfo("完成", "批量处理完成！")
+            total = len(image_files)
+            succeeded = completed[0] - len(failed)
+            if self.model_error is not None:
+                self.status_var.set(f"批量处理已中止: 成功 {succeeded}/{total} 张")
+                messagebox.showerror(
+                    "处理中止",
+                    f"{self.model_error}\n\n已成功 {succeeded} 张，"
+                    f"失败 {len(failed)} 张，未处理 {total - completed[0]} 张"
+                )
+            elif failed:
+                self.status_var.set(f"批量处理完成: 成功 {succeeded}/{total} 张，失败 {len(failed)} 张")
+                messagebox.showwarning(
+                    "完成",
+                    f"共 {total} 张图片，成功 {succeeded} 张，失败 {len(failed)} 张:\n"
+                    + "\n".join(failed[:10]) + ("\n..." if len(failed) > 10 else "")
+                )
+            else:
+                self.status_var.set(f"批量处理完成! 共处理 {total} 张图片")
+                messagebox.showinfo("完成", f"批量处理完成！共 {total} 张图片")
+
+        # 只让少量批处理任务排队，交互请求可随时插到它们前面；
+        # 同时处理的张数再按内存预算自动收放，大图先做
+        runner = AdaptiveBatchRunner(
+            lambda img_path: self.submit_cutout(img_path, settings, PRIORITY_BATCH),
+            max_concurrency=BATCH_WINDOW * self.scheduler.workers
+        )
 
         # 在后台线程中处理
         threading.Thread(target=worker, daemon=True).start()
 
+    def toggle_tracing(self):
+        """开启/关闭性能追踪"""
+        if self.trace_var.get():
+            tracing.clear()
+            tracing.enable()
+            self.status_var.set("性能追踪已开启，处理完成后可在“工具”菜单中导出")
+        else:
+            tracing.disable()
+            self.status_var.set("性能追踪已关闭")
+
+    def export_trace(self):
+        """导出性能追踪（Chrome trace-event JSON）"""
+        output_path = filedialog.asksaveasfilename(
+            title="导出性能追踪",
+            defaultextension=".json",
+            initialfile="repicbg_trace.json",
+            filetypes=[("Chrome Trace", "*.json")]
+        )
+        if not output_path:
+            return
+        try:
+            count = tracing.export(output_path)
+        except OSError as e:
+            messagebox.showerror("导出失败", f"无法写入文件:\n{str(e)}")
+            return
+        messagebox.showinfo("导出完成", f"已导出 {count} 个事件\n可在 https://ui.perfetto.dev 中打开查看")
+
+    def toggle_watch(self):
+        """开始/停止监视文件夹，新照片按当前背景设置自动处理"""
+        if self.watcher is not None:
+            self.watcher.stop(wait=False)
+            self.watcher = None
+            self.watch_btn.configure(text="监视文件夹")
+            self.status_var.set("已停止监视文件夹")
+            return
+
+        if not self.check_background():
+            return
+
+        input_dir = filedialog.askdirectory(title="选择监视的输入文件夹")
+        if not input_dir:
+            return
+        output_dir = filedialog.askdirectory(title="选择输出文件夹")
+        if not output_dir:
+            return
+
+        settings = self.current_settings()
+        self.reset_model_error()
+
+        def submit(img_path):
+            return self.submit_cutout(img_path, settings, PRIORITY_BATCH)
+
+        def handle_batch(paths):
+            self.status_var.set(f"监视中: 正在处理 {len(paths)} 张新图片")
+            written = process_batch(paths, submit, output_dir, log=print)
+            failed = len(paths) - len(written)
+            self.status_var.set(f"监视中: 已处理 {len(written)} 张新图片"
+                                + (f"，{failed} 张失败" if failed else "") + f" - {input_dir}")
+            return written
+
+        try:
+            self.watcher = HotFolderWatcher(input_dir, handle_batch)
+            self.watcher.skip_processed(output_dir)
+            self.watcher.start()
+        except Exception as e:
+            self.watcher = None
+            messagebox.showerror("监视失败", f"无法监视文件夹:\n{str(e)}")
+            return
+
+        self.watch_btn.configure(text="停止监视")
+        self.status_var.set(f"正在监视: {input_dir}（{self.watcher.source.name}）")
+
     def batch_export(self):
         """批量导出图片"""
         if not self.image_files:
@@ -693,6 +1073,65 @@ class AIBackgroundReplacer(TkinterDnD.Tk):
         # 在后台线程中处理
         threading.Thread(target=worker, daemon=True).start()
 
+    def reexport_from_mattes(self):
+        """用已存蒙版按当前背景设置重新合成导出（不加载AI模型）"""
+        if not self.image_files:
+            messagebox.showwarning("操作提示", "请先添加图片!")
+            return
+        if not self.check_background():
+            return
+
+        output_dir = filedialog.askdirectory(title="选择导出文件夹")
+        if not output_dir:
+            return
+
+        self.progress["maximum"] = len(self.image_files)
+        self.progress["value"] = 0
+
+        image_files = list(self.image_files)
+        settings = self.current_settings()
+        fmt = self.export_format_var.get()
+
+        def worker():
+            exported = 0
+            missing = []
+            for i, img_path in enumerate(image_files, 1):
+                filename = os.path.basename(img_path)
+                try:
+                    mask = self.matte_store.get(self.matte_store.digest(img_path), MODEL_KEY)
+                    if mask is None:
+                        missing.append(filename)
+                        continue
+
+                    name, _ = os.path.splitext(filename)
+                    output_path = os.path.join(output_dir, f"{name}_processed{EXPORT_FORMATS[fmt]}")
+                    img = self.image_store.get(img_path, keep=False)
+                    with open(output_path, "wb") as f:
+                        f.write(encode_image(cutout(img, mask, **settings), fmt))
+                    exported += 1
+
+                except Exception as e:
+                    print(f"导出 {img_path} 失败: {str(e)}")
+
+                finally:
+                    # 更新进度（没有蒙版或失败的图片也计入）
+                    self.progress["value"] = i
+                    self.status_var.set(f"导出中: {i}/{len(image_files)} - {filename}")
+
+            # 处理完成
+            self.status_var.set(f"导出完成! 共导出 {exported} 张图片")
+            if missing:
+                messagebox.showinfo(
+                    "完成",
+                    f"已导出 {exported} 张图片。\n以下 {len(missing)} 张没有已存蒙版，请先用“替换背景”处理:\n"
+                    + "\n".join(missing[:10]) + ("\n..." if len(missing) > 10 else "")
+                )
+            else:
+                messagebox.showinfo("完成", "重新导出完成！")
+
+        # 在后台线程中处理
+        threading.Thread(target=worker, daemon=True).start()
+
 # ======================== 主程序 ========================
 if __name__ == "__main__":
     # 检查依赖
@@ -709,5 +1148,9 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    # --trace PATH：启动即记录性能追踪，退出时导出
+    if "--trace" in sys.argv[1:-1]:
+        tracing.enable_with_export(sys.argv[sys.argv.index("--trace") + 1])
+
     app = AIBackgroundReplacer()
     app.mainloop()    
\ No newline at end of file
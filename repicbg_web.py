@@ -1,11 +1,24 @@
 import streamlit as st
 import os
 import time
+import uuid
 import zipfile
 import io
+from concurrent.futures import TimeoutError
 from PIL import Image
-from rembg import remove, new_session
+from rembg import new_session
 import numpy as np
+from matting import load_image, predict_mask, cutout
+from backgrounds import GRADIENT_DIRECTIONS, gradient_spec, image_spec
+from inference_pool import InferencePool, INFERENCE_WORKERS, ORT_THREADS
+from matte_store import MatteStore
+from id_photo import PHOTO_SIZES
+from scheduler import FairScheduler
+import tracing
+
+MODEL_NAME = "u2net"
+# 所有会话合计同时处理的图片数，0 表示自动（推理进程数，未启用进程池时为 1）
+WEB_CONCURRENCY = int(os.environ.get("REPICBG_WEB_CONCURRENCY", "0"))
 
 # 设置页面
 st.set_page_config(
@@ -15,47 +28,73 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# 缓存模型加载
+# 缓存模型加载（首次需要推理时才加载）
 @st.cache_resource
 def load_model():
-    return new_session("u2net")
+    return new_session(MODEL_NAME)
+
+# 缓存推理进程池（REPICBG_WORKERS>0 时启用，所有会话共享）
+@st.cache_resource
+def load_pool():
+    return InferencePool(INFERENCE_WORKERS, ORT_THREADS, MODEL_NAME)
+
+# 已存蒙版（所有会话共享）
+@st.cache_resource
+def load_matte_store():
+    return MatteStore()
+
+# 共享推理调度器：并发数固定，各会话轮流执行，人多时也不会超额占用CPU
+@st.cache_resource
+def load_executor():
+    return FairScheduler(WEB_CONCURRENCY or max(1, INFERENCE_WORKERS))
+
+# 解析颜色
+def hex_to_rgb(value):
+    """将 #RRGGBB 转换为 (R, G, B)"""
+    return tuple(int(value.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
 
 # 处理单张图片
-def process_image(image, bg_color=None):
+@tracing.traced("process_image")
+def process_image(image, bg_color=None, refine=False, mask_options=None, background=None, photo_size=None):
     """
     处理单张图片，移除背景并应用新背景
     
     参数:
-        image: PIL图像对象
+        image: 图片字节（可据此复用已存蒙版）或PIL图像对象
         bg_color: 背景颜色 (R, G, B) 或 None表示透明背景
+        refine: 是否做边缘精修
+        mask_options: 蒙版后处理参数（threshold/min_area/fill_holes/feather）
+        background: 渐变/图片背景描述，优先于 bg_color
+        photo_size: 证件照尺寸（PHOTO_SIZES 的键），None 表示保持原图尺寸
         
     返回:
         处理后的PIL图像对象
     """
-    # 将图像转换为字节
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format='PNG')
-    img_bytes = img_byte_arr.getvalue()
-    
+    img = load_image(image)
+
     # 设置背景颜色
     if bg_color:
         # 转换为整数元组 (R, G, B)
         bg_color = tuple(int(bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-        # 添加Alpha通道
-        bg_color = bg_color + (255,)
     else:
         # 透明背景
-        bg_color = (255, 255, 255, 0)
-    
-    # 移除背景
-    result = remove(
-        img_bytes,
-        session=st.session_state.model,
-        bgcolor=bg_color
-    )
-    
-    # 将结果转换为PIL图像
-    return Image.open(io.BytesIO(result))
+        bg_color = None
+
+    # 计算人像蒙版
+    def compute_mask():
+        if INFERENCE_WORKERS > 0:
+            return load_pool().predict(img)
+        return predict_mask(load_model(), img)
+
+    if isinstance(image, bytes):
+        # 同一张图片处理过就直接读取已存蒙版，不需要推理
+        mask = load_matte_store().get_or_compute(image, MODEL_NAME, compute_mask)
+    else:
+        mask = compute_mask()
+
+    # 合成新背景
+    return cutout(img, mask, bg_color, refine=refine, background=background,
+                  photo_size=photo_size, **(mask_options or {}))
 
 # 创建ZIP文件
 def create_zip(processed_images):
@@ -72,22 +111,22 @@ def create_zip(processed_images):
     with zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip_file:
         for i, img in enumerate(processed_images):
             img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
+            img.save(img_byte_arr, format='PNG', dpi=img.info.get("dpi"))
             zip_file.writestr(f"processed_{i+1}.png", img_byte_arr.getvalue())
     
     zip_buffer.seek(0)
     return zip_buffer
 
 # 初始化会话状态
-if 'model' not in st.session_state:
-    st.session_state.model = load_model()
-
 if 'uploaded_files' not in st.session_state:
     st.session_state.uploaded_files = []
 
 if 'processed_images' not in st.session_state:
     st.session_state.processed_images = []
 
+if 'user_id' not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+
 # 页面标题
 st.title("🖼️ AI批量抠图换背景工具")
 st.markdown("""
@@ -99,36 +138,97 @@ with st.sidebar:
     st.header("⚙️ 设置选项")
     
     # 背景类型选择
-    bg_type = st.radio("背景类型", ["纯色背景", "透明背景"], index=0)
+    bg_type = st.radio("背景类型", ["纯色背景", "透明背景", "渐变背景", "图片背景"], index=0)
     
     # 颜色选择器（仅在纯色背景时显示）
     bg_color = None
+    background = None
     if bg_type == "纯色背景":
         bg_color = st.color_picker("选择背景颜色", "#FFFFFF")
+    elif bg_type == "渐变背景":
+        start = st.color_picker("起始颜色", "#FFFFFF")
+        end = st.color_picker("终止颜色", "#438EDB")
+        direction = st.selectbox("渐变方向", list(GRADIENT_DIRECTIONS),
+                                 format_func=GRADIENT_DIRECTIONS.get)
+        background = gradient_spec(hex_to_rgb(start), hex_to_rgb(end), direction)
+    elif bg_type == "图片背景":
+        backdrop_file = st.file_uploader("上传背景图片", type=["png", "jpg", "jpeg", "bmp"])
+        if backdrop_file is not None:
+            background = image_spec(backdrop_file.getvalue())
+        else:
+            st.caption("请上传背景图片后再开始处理")
+
+    # 证件照尺寸
+    photo_size = st.selectbox("输出尺寸", [None] + list(PHOTO_SIZES),
+                              format_func=lambda key: "原图尺寸" if key is None else PHOTO_SIZES[key][0],
+                              help="按人像位置自动裁剪缩放为标准证件照（300 dpi），文件更小，可直接打印")
+
+    # 边缘精修
+    refine = st.checkbox("边缘精修（发丝更自然）", value=False,
+                         help="在人像边缘窄带内按原图细节修正蒙版，比 alpha matting 快得多")
+
+    # 蒙版后处理
+    with st.expander("蒙版后处理"):
+        mask_options = {
+            "threshold": st.slider("置信度阈值", 0, 254, 0,
+                                   help="低于该值的半透明像素直接变为透明，0 表示不处理"),
+            "min_area": 0.5 if st.checkbox("去除背景杂点", value=False) else 0.0,
+            "fill_holes": st.checkbox("填补衣物空洞", value=False),
+            "feather": st.slider("边缘羽化(像素)", 0, 20, 0),
+        }
     
     # 批量处理按钮
     if st.button("🚀 开始批量处理", use_container_width=True, type="primary"):
         if not st.session_state.uploaded_files:
             st.warning("请先上传图片")
+        elif bg_type == "图片背景" and background is None:
+            # 与桌面版一致：选择了图片背景就必须有背景图片，不悄悄改用其他背景
+            st.warning("请先上传背景图片，或改用其他背景类型")
         else:
             with st.spinner("正在处理图片..."):
                 st.session_state.processed_images = []
                 progress_bar = st.progress(0)
                 status_text = st.empty()
                 
-                for i, uploaded_file in enumerate(st.session_state.uploaded_files):
-                    # 更新进度
-                    progress = int((i + 1) / len(st.session_state.uploaded_files) * 100)
-                    progress_bar.progress(progress)
-                    status_text.text(f"处理中: {i+1}/{len(st.session_state.uploaded_files)} - {uploaded_file.name}")
-                    
-                    # 读取图片
-                    image = Image.open(uploaded_file)
-                    
-                    # 处理图片
-                    processed_image = process_image(image, bg_color if bg_type == "纯色背景" else None)
-                    st.session_state.processed_images.append(processed_image)
-                
+                files = st.session_state.uploaded_files
+                executor = load_executor()
+                user_id = st.session_state.user_id
+
+                # 撤掉本会话尚未开始的旧任务，再把所有图片交给共享调度器排队
+                executor.cancel(user_id)
+                def job(image, queued):
+                    tracing.record("queue_wait", queued, tracing.now(), {"user": user_id})
+                    return process_image(image, bg_color, refine, mask_options, background, photo_size)
+
+                futures = [
+                    executor.submit(user_id, lambda image=uploaded_file.getvalue(), queued=tracing.now(): job(image, queued))
+                    for uploaded_file in files
+                ]
+
+                try:
+                    for i, (uploaded_file, future) in enumerate(zip(files, futures)):
+                        # 等待结果，期间显示排队位置
+                        while True:
+                            try:
+                                processed_image = future.result(timeout=0.5)
+                                break
+                            except TimeoutError:
+                                ahead = executor.position(user_id, future)
+                                if ahead is not None:
+                                    running, queued, users = executor.status()
+                                    status_text.text(f"排队中: 前面还有 {ahead} 张图片"
+                                                     f"（{users} 位用户排队，{running} 张正在处理） - {uploaded_file.name}")
+                                else:
+                                    status_text.text(f"处理中: {i+1}/{len(files)} - {uploaded_file.name}")
+                        st.session_state.processed_images.append(processed_image)
+
+                        # 更新进度
+                        progress_bar.progress(int((i + 1) / len(files) * 100))
+                        status_text.text(f"已完成: {i+1}/{len(files)} - {uploaded_file.name}")
+                finally:
+                    # 页面刷新或出错中断时不再占用共享队列
+                    executor.cancel(user_id)
+
                 progress_bar.empty()
                 status_text.success("✅ 处理完成!")
     
@@ -148,6 +248,23 @@ with st.sidebar:
             use_container_width=True
         )
     
+    # 性能追踪（设置环境变量 REPICBG_TRACE 后开启）
+    # 事件可达上百万条，只在点击时生成JSON，不在每次页面重跑时生成
+    if tracing.enabled():
+        if st.button("📊 生成性能追踪", use_container_width=True):
+            st.session_state.trace_data = tracing.dumps()
+        if 'trace_data' in st.session_state:
+            st.download_button(
+                label="📥 下载性能追踪",
+                data=st.session_state.trace_data,
+                file_name="repicbg_trace.json",
+                mime="application/json",
+                help="Chrome trace-event 格式，可在 https://ui.perfetto.dev 中打开",
+                # 下载后释放，不在会话中长期保留
+                on_click=lambda: st.session_state.pop('trace_data', None),
+                use_container_width=True
+            )
+
     # 重置按钮
     if st.button("🔄 重置所有内容", use_container_width=True):
         st.session_state.uploaded_files = []
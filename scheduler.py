@@ -0,0 +1,270 @@
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+# 数值越小越先执行
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+def _sizeof(value):
+    """估算缓存对象占用的字节数"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    if hasattr(value, "size") and hasattr(value, "getbands"):
+        width, height = value.size
+        return width * height * len(value.getbands())
+    return 1
+
+
+class ResultCache:
+    """按字节数限制容量的LRU结果缓存（线程安全）"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+class PriorityScheduler:
+    """
+    交互请求与批处理共用的优先级任务调度器
+
+    所有推理任务都经由同一个队列执行，交互请求（PRIORITY_INTERACTIVE）
+    总是排在尚未开始的批处理任务之前；同一 key 的任务只计算一次，
+    完成的结果进入 LRU 缓存，之后的请求直接从内存返回。
+    """
+
+    def __init__(self, workers=1, cache=None):
+        self.cache = cache if cache is not None else ResultCache()
+        self._heap = []
+        self._queued = {}   # key -> 队列中的条目
+        self._running = {}  # key -> 正在执行的 Future
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._run, name=f"scheduler-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def workers(self):
+        return len(self._threads)
+
+    def submit(self, key, func, priority=PRIORITY_BATCH):
+        """
+        提交任务
+
+        参数:
+            key: 结果缓存键，None 表示不缓存也不去重
+            func: 无参可调用对象，返回任务结果
+            priority: 优先级，数值越小越优先
+
+        返回:
+            concurrent.futures.Future
+        """
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                future = Future()
+                future.set_result(cached)
+                return future
+
+        with self._cond:
+            if key is not None:
+                running = self._running.get(key)
+                if running is not None:
+                    return running
+
+                entry = self._queued.get(key)
+                if entry is not None:
+                    # 已在队列中：交互请求将其提升到更高优先级
+                    if priority < entry[0]:
+                        entry[3] = None
+                        entry = [priority, next(self._counter), key, func, entry[4]]
+                        self._queued[key] = entry
+                        heapq.heappush(self._heap, entry)
+                        self._cond.notify()
+                    return entry[4]
+
+            future = Future()
+            entry = [priority, next(self._counter), key, func, future]
+            if key is not None:
+                self._queued[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+            return future
+
+    def pending(self):
+        """队列中尚未开始的任务数"""
+        with self._cond:
+            return sum(1 for entry in self._heap if entry[3] is not None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, key, func, future = heapq.heappop(self._heap)
+                if func is None:
+                    # 已被提升优先级的旧条目
+                    continue
+                if key is not None:
+                    self._queued.pop(key, None)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if key is not None:
+                    self._running[key] = future
+
+            try:
+                result = func()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                if key is not None:
+                    self.cache.put(key, result)
+                future.set_result(result)
+            finally:
+                if key is not None:
+                    with self._cond:
+                        self._running.pop(key, None)
+
+
+class FairScheduler:
+    """
+    多用户共享的公平推理调度器
+
+    并发数固定，每个用户一个先进先出队列，工作线程在有任务的用户之间
+    轮流取任务：某个用户一次提交再多图片，其他用户的任务也只需等每人一张。
+    """
+
+    def __init__(self, workers=1):
+        self._queues = OrderedDict()  # 用户 -> deque[(func, future)]，顺序即轮转顺序
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._run, name=f"fair-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def workers(self):
+        return len(self._threads)
+
+    def submit(self, user, func):
+        """
+        提交任务
+
+        参数:
+            user: 用户标识（如网页会话ID）
+            func: 无参可调用对象，返回任务结果
+
+        返回:
+            concurrent.futures.Future
+        """
+        future = Future()
+        with self._cond:
+            queue = self._queues.get(user)
+            if queue is None:
+                queue = self._queues[user] = deque()
+            queue.append((func, future))
+            self._cond.notify()
+        return future
+
+    def position(self, user, future):
+        """
+        任务前面还要执行的任务数（按轮转顺序推算，0 表示下一个执行），
+        已开始或不在队列中时返回 None
+        """
+        with self._cond:
+            queue = self._queues.get(user)
+            if not queue:
+                return None
+            for k, (_, queued) in enumerate(queue):
+                if queued is future:
+                    break
+            else:
+                return None
+
+            ahead = k
+            before = True  # 轮转顺序中排在该用户前面的用户，本轮也会先执行一次
+            for other, other_queue in self._queues.items():
+                if other == user:
+                    before = False
+                    continue
+                ahead += min(len(other_queue), k + 1 if before else k)
+            return ahead
+
+    def status(self):
+        """返回 (正在执行数, 排队任务数, 排队用户数)"""
+        with self._cond:
+            queued = sum(len(queue) for queue in self._queues.values())
+            return self._running, queued, len(self._queues)
+
+    def cancel(self, user):
+        """取消某个用户尚未开始的全部任务（如会话中断、重新提交时）"""
+        with self._cond:
+            queue = self._queues.pop(user, None)
+        for _, future in queue or ():
+            future.cancel()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                user, queue = next(iter(self._queues.items()))
+                func, future = queue.popleft()
+                # 取过任务的用户移到末尾，轮到下一个用户
+                if queue:
+                    self._queues.move_to_end(user)
+                else:
+                    del self._queues[user]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running += 1
+
+            try:
+                result = func()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running -= 1
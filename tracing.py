@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import multiprocessing
+
+# ======================== 配置部分 ========================
+# 设为输出文件路径即开启追踪，程序退出时自动导出
+TRACE_PATH = os.environ.get("REPICBG_TRACE", "")
+# 最多记录的事件数，超出后不再记录，避免长时间运行占满内存
+MAX_EVENTS = 1000000
+
+_enabled = False
+_events = []
+_named = set()  # 已写入线程名的线程
+_lock = threading.Lock()
+_origin = time.perf_counter_ns()
+
+
+def now():
+    """当前时间戳（纳秒，与 record 的参数一致）"""
+    return time.perf_counter_ns()
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    """开启追踪"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """关闭追踪（已记录的事件保留，可继续导出）"""
+    global _enabled
+    _enabled = False
+
+
+def clear():
+    with _lock:
+        _events.clear()
+        _named.clear()
+
+
+def _thread_id():
+    tid = threading.get_native_id()
+    if tid not in _named:
+        with _lock:
+            if tid not in _named:
+                _named.add(tid)
+                _events.append({
+                    "ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                })
+    return tid
+
+
+def _foreign_thread(pid, tid, process_name):
+    """为其他进程（如推理进程）的线程写入进程名"""
+    if (pid, tid) not in _named:
+        with _lock:
+            if (pid, tid) not in _named:
+                _named.add((pid, tid))
+                _events.append({
+                    "ph": "M", "name": "process_name", "pid": pid, "tid": tid,
+                    "args": {"name": process_name},
+                })
+    return tid
+
+
+def record(name, start, end, args=None, pid=None, tid=None, process_name="子进程"):
+    """
+    记录一段已结束的区间（start/end 为 now() 的返回值）
+
+    pid/tid 用于记录其他进程回报的区间：now() 基于系统级单调时钟，
+    同一台机器上不同进程的取值可以直接比较。
+    """
+    if not _enabled or len(_events) >= MAX_EVENTS:
+        return
+    if pid is None:
+        pid, tid = os.getpid(), _thread_id()
+    else:
+        tid = _foreign_thread(pid, tid, process_name)
+    event = {
+        "ph": "X", "name": name, "pid": pid, "tid": tid,
+        "ts": (start - _origin) / 1000, "dur": (end - start) / 1000,
+    }
+    if args:
+        event["args"] = args
+    _events.append(event)
+
+
+def counter(name, **values):
+    """记录计数器取值（如内存占用、并发数），在 Perfetto 中显示为折线"""
+    if not _enabled or len(_events) >= MAX_EVENTS:
+        return
+    _events.append({
+        "ph": "C", "name": name, "pid": os.getpid(),
+        "ts": (now() - _origin) / 1000, "args": values,
+    })
+
+
+class _NullSpan:
+    """未开启追踪时使用的空区间，没有任何开销"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, now(), self.args)
+        return False
+
+
+def span(name, **args):
+    """
+    记录一段代码的耗时
+
+    用法:
+        with tracing.span("decode", path=path):
+            ...
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """函数装饰器：每次调用记录一个区间，未开启追踪时直接调用原函数"""
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(label, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dumps():
+    """导出为 Chrome trace-event JSON 字符串（可用 Perfetto / chrome://tracing 打开）"""
+    with _lock:
+        events = list(_events)
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, ensure_ascii=False)
+
+
+def export(path):
+    """导出到文件，返回记录的事件数"""
+    data = dumps()
+    # 临时文件名带进程号，多个进程导出到同一路径时不会互相覆盖半个文件
+    tmp_path = f"{path}.{os.getpid()}.part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(_events)
+
+
+def _export_at_exit(path):
+    if _events:
+        try:
+            count = export(path)
+            print(f"性能追踪已导出: {path}（{count} 个事件）")
+        except OSError as e:
+            print(f"导出性能追踪失败: {str(e)}")
+
+
+def enable_with_export(path):
+    """开启追踪，并在程序退出时导出到 path（命令行 --trace 使用）"""
+    enable()
+    atexit.register(_export_at_exit, path)
+
+
+# 只在主进程开启；推理等子进程继承了环境变量，但它们的耗时由主进程代为记录
+# （spawn 子进程导入模块时 parent_process() 尚未设置，进程名则已设置）
+if TRACE_PATH and multiprocessing.current_process().name == "MainProcess":
+    enable_with_export(TRACE_PATH)
@@ -0,0 +1,466 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import argparse
+
+VALID_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def output_path_for(img_path, output_dir):
+    """与批量替换背景相同的输出文件命名"""
+    name, ext = os.path.splitext(os.path.basename(img_path))
+    return os.path.join(output_dir, f"{name}_processed{ext}")
+
+
+def _is_candidate(name):
+    """只处理图片文件，跳过隐藏/临时文件和已处理的输出"""
+    if name.startswith('.') or name.startswith('~'):
+        return False
+    stem, ext = os.path.splitext(name)
+    return ext.lower() in VALID_EXTENSIONS and not stem.endswith("_processed")
+
+
+# ======================== 事件源 ========================
+class _InotifySource:
+    """
+    Linux inotify 事件源：报告新建、写完关闭和移入的文件
+
+    不订阅 IN_MODIFY（每次 write 都会触发，处理批次期间容易撑满内核队列）。
+    队列溢出时事件会丢失，此时以及每隔 rescan 秒都列一次目录兜底。
+    """
+
+    name = "inotify"
+
+    def __init__(self, folder, rescan=30.0):
+        self.folder = folder
+        self.rescan = rescan
+        self._last_listing = time.monotonic()
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"无法监视文件夹: {folder}")
+
+    def _list(self):
+        self._last_listing = time.monotonic()
+        try:
+            return [(name, False) for name in os.listdir(self.folder)]
+        except OSError:
+            return []
+
+    def wait(self, timeout):
+        """返回 [(文件名, 是否已写完)]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        events = []
+        overflow = False
+        while ready:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    events.append((os.fsdecode(name), bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+
+        if overflow or time.monotonic() - self._last_listing >= self.rescan:
+            events.extend(self._list())
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingSource:
+    """
+    轮询事件源：报告新增/变化的文件
+
+    目录修改时间变化时列目录；向已有文件追加写入不会改变目录修改时间，
+    所以最近 recent 秒内变化过的文件（包括刚处理过的）每次轮询都重新 stat，
+    另外每隔 rescan 秒无条件列一次目录兜底（网络共享的目录时间不一定可靠）。
+    """
+
+    name = "轮询"
+
+    def __init__(self, folder, interval=1.0, recent=300.0, rescan=30.0):
+        self.folder = folder
+        self.interval = interval
+        self.recent = recent
+        self.rescan = rescan
+        self._dir_mtime = None
+        self._last_listing = 0.0
+        self._changed = {}  # 文件名 -> 最近一次发现变化的时刻
+        # 启动时的目录快照，已有文件由 HotFolderWatcher.start 决定是否处理
+        self._known = {}
+        self._scan()
+
+    def _list(self, now):
+        """列目录，返回相对上次快照新增或变化的文件名"""
+        self._last_listing = now
+        names = []
+        known = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                known[entry.name] = sig
+                if self._known.get(entry.name) != sig:
+                    names.append(entry.name)
+        self._known = known
+        return names
+
+    def _restat_recent(self, now):
+        """重新 stat 最近变化过的文件，返回其中又有变化的文件名"""
+        names = []
+        for name, changed in list(self._changed.items()):
+            if now - changed > self.recent:
+                del self._changed[name]
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue  # 已删除，下次列目录时从快照中去掉
+            sig = (st.st_size, st.st_mtime_ns)
+            if self._known.get(name) != sig:
+                self._known[name] = sig
+                names.append(name)
+        return names
+
+    def _scan(self):
+        now = time.monotonic()
+        try:
+            dir_mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return []
+
+        if dir_mtime != self._dir_mtime or now - self._last_listing >= self.rescan:
+            self._dir_mtime = dir_mtime
+            names = self._list(now)
+        else:
+            names = self._restat_recent(now)
+
+        for name in names:
+            self._changed[name] = now
+        return names
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return [(name, False) for name in self._scan()]
+
+    def close(self):
+        pass
+
+
+# ======================== 监视器 ========================
+class HotFolderWatcher:
+    """
+    热文件夹监视器
+
+    新文件写入完成（大小和修改时间在 settle 秒内不再变化）后进入就绪队列，
+    就绪文件凑满 batch_size 张或最早一张等待超过 max_wait 秒时，
+    整批交给 handle_batch(paths) 处理。handle_batch 返回成功输出的路径，
+    只有这些文件记为已处理；失败的文件之后被修改（如写入方补完）时会重新处理。
+
+    settle 默认 inotify 下 0.5 秒、轮询下 3 秒（网络共享上的写入常有停顿）。
+    """
+
+    INOTIFY_SETTLE = 0.5
+    POLLING_SETTLE = 3.0
+
+    def __init__(self, folder, handle_batch, settle=None, batch_size=8,
+                 max_wait=0.5, poll_interval=1.0, use_inotify=True):
+        self.folder = os.path.abspath(folder)
+        self.handle_batch = handle_batch
+        self._settle_option = settle
+        self.settle = settle if settle is not None else self.INOTIFY_SETTLE
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and sys.platform.startswith("linux")
+
+        self._candidates = {}  # 路径 -> (大小, 修改时间, 最近变化时刻)
+        self._ready = []       # [(路径, 修改时间, 就绪时刻)]
+        self._done = {}        # 路径 -> 已处理时的修改时间
+        self._stop = threading.Event()
+        self._thread = None
+        self.source = None
+
+    def start(self, include_existing=True):
+        """开始监视；include_existing 时先处理目录中尚未有输出的图片"""
+        self.source = None
+        if self.use_inotify:
+            try:
+                self.source = _InotifySource(self.folder)
+            except (OSError, AttributeError) as e:
+                print(f"inotify 不可用，改用轮询: {str(e)}")
+        if self.source is None:
+            self.source = _PollingSource(self.folder, self.poll_interval)
+        if self._settle_option is None:
+            self.settle = self.INOTIFY_SETTLE if isinstance(self.source, _InotifySource) \
+                else max(self.POLLING_SETTLE, 2 * self.poll_interval)
+
+        for name in os.listdir(self.folder):
+            if include_existing:
+                self._touch(name)
+            elif _is_candidate(name):
+                # 已有文件记为处理过，兜底重新列目录时不会被当成新文件
+                self.mark_done(os.path.join(self.folder, name))
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """停止监视；wait=False 时不等待正在处理的批次结束"""
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def mark_done(self, path):
+        """记录已处理的文件，之后不再重复处理（除非文件被修改）"""
+        try:
+            self._done[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+
+    def skip_processed(self, output_dir):
+        """输出文件夹中已有结果的图片视为处理过"""
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if _is_candidate(name) and os.path.exists(output_path_for(path, output_dir)):
+                self.mark_done(path)
+
+    def _touch(self, name, closed=False):
+        if not _is_candidate(name):
+            return
+        path = os.path.join(self.folder, name)
+        if not closed:
+            self._candidates[path] = (-1, -1, time.monotonic())
+            return
+        # 写入方已关闭文件（或整个文件移入），不必再等待去抖
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self._candidates[path] = (st.st_size, st.st_mtime_ns, time.monotonic() - self.settle)
+
+    def _check_candidates(self, now):
+        for path, (size, mtime, changed) in list(self._candidates.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # 被移走或删除
+                del self._candidates[path]
+                continue
+
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self._candidates[path] = (st.st_size, st.st_mtime_ns, now)
+            elif now - changed >= self.settle and st.st_size > 0:
+                del self._candidates[path]
+                if self._done.get(path) != st.st_mtime_ns:
+                    self._ready.append((path, st.st_mtime_ns, now))
+
+    def _flush(self, now, force=False):
+        while self._ready and (force or len(self._ready) >= self.batch_size
+                               or now - self._ready[0][2] >= self.max_wait):
+            batch = self._ready[:self.batch_size]
+            del self._ready[:self.batch_size]
+            paths = [path for path, _, _ in batch]
+            try:
+                succeeded = set(self.handle_batch(paths) or ())
+            except Exception as e:
+                print(f"处理批次失败: {str(e)}")
+                succeeded = set()
+            # 只记录成功输出的文件；失败的文件被修改后会再次进入候选
+            for path, mtime, _ in batch:
+                if path in succeeded:
+                    self._done[path] = mtime
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                # 有待定文件时缩短等待，尽快完成去抖
+                busy = self._candidates or self._ready
+                timeout = min(self.settle, self.max_wait) / 2 if busy else self.poll_interval
+                for name, closed in self.source.wait(timeout):
+                    self._touch(name, closed)
+
+                now = time.monotonic()
+                self._check_candidates(now)
+                self._flush(now)
+        finally:
+            self.source.close()
+
+
+def process_batch(paths, submit, output_dir, log=print):
+    """
+    按内存预算并发提交一批图片并写出结果
+
+    参数:
+        paths: 图片路径列表
+        submit: submit(path) -> Future，结果为PNG字节
+        output_dir: 输出文件夹
+        log: 日志函数
+
+    返回:
+        成功写出结果的图片路径列表
+    """
+    from adaptive import AdaptiveBatchRunner
+    import tracing
+
+    written = []
+
+    def finish(index, path, future):
+        try:
+            result = future.result()
+            output_path = output_path_for(path, output_dir)
+            # 先写临时文件再改名，下游不会读到半个文件
+            tmp_path = output_path + ".part"
+            with tracing.span("write_output", path=output_path):
+                with open(tmp_path, "wb") as f:
+                    f.write(result)
+                os.replace(tmp_path, output_path)
+            written.append(path)
+            log(f"已输出: {output_path}")
+        except Exception as e:
+            log(f"处理 {path} 失败: {str(e)}")
+
+    # 按内存预算控制同时处理的张数，大图先做
+    with tracing.span("watch_batch", count=len(paths)):
+        AdaptiveBatchRunner(submit, max_concurrency=len(paths)).run(paths, finish)
+    return written
+
+
+def parse_color(value):
+    """解析 #RRGGBB 颜色"""
+    value = value.lstrip('#')
+    return tuple(int(value[i:i+2], 16) for i in (0, 2, 4))
+
+
+# ======================== 命令行入口 ========================
+def main(argv=None):
+    from id_photo import PHOTO_SIZES
+
+    parser = argparse.ArgumentParser(description="监视文件夹，自动为新照片替换背景")
+    parser.add_argument("input_dir", help="监视的输入文件夹")
+    parser.add_argument("output_dir", help="结果输出文件夹")
+    parser.add_argument("--bg-color", default="#FFFFFF", help="背景颜色，默认 #FFFFFF")
+    parser.add_argument("--transparent", action="store_true", help="使用透明背景")
+    parser.add_argument("--bg-image", help="背景图片路径")
+    parser.add_argument("--gradient", nargs=2, metavar=("START", "END"), help="渐变背景的起止颜色")
+    parser.add_argument("--gradient-direction", default="vertical",
+                        choices=["vertical", "horizontal", "radial"], help="渐变方向")
+    parser.add_argument("--refine", action="store_true", help="边缘精修")
+    parser.add_argument("--threshold", type=int, default=0, help="蒙版置信度阈值 (0-254)")
+    parser.add_argument("--min-area", type=float, default=0.0, help="去除面积小于图片该百分比的杂点")
+    parser.add_argument("--fill-holes", action="store_true", help="填补前景内部的空洞")
+    parser.add_argument("--feather", type=int, default=0, help="边缘羽化半径（像素）")
+    parser.add_argument("--photo-size", choices=list(PHOTO_SIZES),
+                        help="按人像位置裁剪为标准证件照尺寸（300 dpi）")
+    parser.add_argument("--settle", type=float, help="文件停止变化多少秒后视为写入完成，默认 inotify 0.5、轮询 3")
+    parser.add_argument("--batch-size", type=int, default=8, help="每批最多处理的图片数")
+    parser.add_argument("--poll", action="store_true", help="强制使用轮询（网络共享目录等不支持 inotify 时）")
+    parser.add_argument("--skip-existing", action="store_true", help="不处理启动前已存在的图片")
+    parser.add_argument("--trace", metavar="PATH", help="记录各阶段耗时，退出时导出 Chrome trace JSON")
+    args = parser.parse_args(argv)
+
+    from matting import load_image, predict_mask, cutout, encode_png
+    from inference_pool import InferencePool, INFERENCE_WORKERS, ORT_THREADS
+    from scheduler import PriorityScheduler
+    from backgrounds import gradient_spec, image_spec
+    from matte_store import MatteStore
+    import tracing
+
+    if args.trace:
+        tracing.enable_with_export(args.trace)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    bgcolor = None if args.transparent else parse_color(args.bg_color)
+    background = None
+    if args.bg_image:
+        background = image_spec(args.bg_image)
+    elif args.gradient:
+        background = gradient_spec(*map(parse_color, args.gradient), args.gradient_direction)
+
+    pool = session = None
+    if INFERENCE_WORKERS > 0:
+        pool = InferencePool(INFERENCE_WORKERS, ORT_THREADS)
+    else:
+        from rembg import new_session
+        session = new_session("u2net")
+
+    store = MatteStore()
+
+    @tracing.traced("cutout_image")
+    def cutout_bytes(path):
+        img = load_image(path)
+        mask = store.get_or_compute(
+            path, "u2net",
+            lambda: pool.predict(img) if pool is not None else predict_mask(session, img)
+        )
+        return encode_png(cutout(
+            img, mask, bgcolor,
+            refine=args.refine,
+            threshold=args.threshold,
+            min_area=args.min_area,
+            fill_holes=args.fill_holes,
+            feather=args.feather,
+            background=background,
+            photo_size=args.photo_size
+        ))
+
+    scheduler = PriorityScheduler(workers=pool.processes if pool else 1)
+
+    def submit(path):
+        # 输出直接写盘，不需要缓存结果
+        return scheduler.submit(None, lambda: cutout_bytes(path))
+
+    watcher = HotFolderWatcher(
+        args.input_dir,
+        lambda paths: process_batch(paths, submit, args.output_dir),
+        settle=args.settle,
+        batch_size=args.batch_size,
+        use_inotify=not args.poll
+    )
+    watcher.skip_processed(args.output_dir)
+    watcher.start(include_existing=not args.skip_existing)
+    print(f"正在监视 {watcher.folder}（{watcher.source.name}），按 Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        if pool is not None:
+            pool.close()
+
+
+if __name__ == "__main__":
+    main()